@@ -1,14 +1,28 @@
-from collections import defaultdict
 from dataclasses import dataclass, field
-from typing import Protocol, override
+from typing import ClassVar, Protocol, override
 
 import numpy as np
+from numpy.typing import DTypeLike, NDArray
 
-from utils import Action, Experiences, Mat, Reward, State, Vec, hash_state
+from optim import OPTIMIZERS, Optimizer
+from qtable import QTable
+from replay import ReplayBuffer
+from utils import (
+    Action,
+    BoolVec,
+    Experiences,
+    IntVec,
+    Mat,
+    ObsBatch,
+    Reward,
+    State,
+    Vec,
+)
 
 
 class Agent(Protocol):
     epsilon: float
+    counterfactual: ClassVar[bool]
 
     def get_action(self, state: State, explore: bool) -> Action: ...
     def update(
@@ -18,11 +32,34 @@ class Agent(Protocol):
         reward: Reward,
         next_state: State,
         terminal: bool,
-        experiences: Experiences,
+        experiences: Experiences | None,
     ) -> float: ...
+    def get_actions(self, obs: ObsBatch, u: IntVec, explore: bool) -> IntVec: ...
+    def update_batch(
+        self,
+        obs: ObsBatch,
+        u: IntVec,
+        actions: IntVec,
+        rewards: Vec,
+        next_obs: ObsBatch,
+        next_u: IntVec,
+        terminals: BoolVec,
+        experiences: Experiences | None,
+    ) -> Vec: ...
     def decay_epsilon(self) -> None: ...
 
 
+def epsilon_greedy(
+    q: Mat, epsilon: float, explore: bool, rng: np.random.Generator
+) -> IntVec:
+    # greedy actions per row, each replaced by a random one with prob. epsilon
+    actions = q.argmax(axis=1)
+    if explore:
+        random = rng.random(len(actions)) < epsilon
+        actions[random] = rng.integers(q.shape[1], size=random.sum())
+    return actions
+
+
 @dataclass
 class QAgent:
     n_actions: int
@@ -31,20 +68,23 @@ class QAgent:
     epsilon: float = 1.0
     epsilon_decay: float = 0.995
     min_epsilon: float = 0.01
-    weights: defaultdict[tuple[int, ...], Vec] = field(init=False)
+    dtype: DTypeLike = np.float64
+    rng: np.random.Generator = field(default_factory=np.random.default_rng)
+    counterfactual: ClassVar[bool] = False
+    weights: QTable = field(init=False)
 
     def __post_init__(self) -> None:
-        self.weights = defaultdict(lambda: np.random.rand(self.n_actions))
+        self.weights = QTable(self.n_actions, self.dtype, rng=self.rng)
 
     def decay_epsilon(self) -> None:
         self.epsilon = max(self.min_epsilon, self.epsilon * self.epsilon_decay)
 
     def get_action(self, state: State, explore: bool = False) -> Action:
         # epsilon greedy action selection
-        key = hash_state(state)
-        if explore and np.random.random() < self.epsilon:
-            return np.random.randint(self.n_actions)
-        return int(np.argmax(self.weights[key]))
+        q = self.weights.get(state)
+        if explore and self.rng.random() < self.epsilon:
+            return int(self.rng.integers(self.n_actions))
+        return int(q.argmax())
 
     def update(
         self,
@@ -53,19 +93,50 @@ class QAgent:
         reward: Reward,
         next_state: State,
         terminal: bool,
-        experiences: Experiences,
+        experiences: Experiences | None,
     ) -> float:
-        # Bellman update
-        k1 = hash_state(state)
-        k2 = hash_state(next_state)
-        current_q = self.weights[k1][action]
-        future_q = (not terminal) * self.gamma * np.max(self.weights[k2])
+        # Bellman update, look up q1 last as the table may grow in between
+        q2 = self.weights.get(next_state)
+        q1 = self.weights.get(state)
+        current_q = q1[action]
+        future_q = (not terminal) * self.gamma * q2.max()
         td_error = reward + future_q - current_q
-        self.weights[k1][action] = current_q + self.alpha * td_error
-        return td_error
+        q1[action] = current_q + self.alpha * td_error
+        return float(td_error)
+
+    def get_actions(self, obs: ObsBatch, u: IntVec, explore: bool = False) -> IntVec:
+        ids = self.weights.intern_all(obs)
+        self.weights.reserve(u.max())
+        return epsilon_greedy(
+            self.weights.values[ids, u], self.epsilon, explore, self.rng
+        )
+
+    def update_batch(
+        self,
+        obs: ObsBatch,
+        u: IntVec,
+        actions: IntVec,
+        rewards: Vec,
+        next_obs: ObsBatch,
+        next_u: IntVec,
+        terminals: BoolVec,
+        experiences: Experiences | None,
+    ) -> Vec:
+        # Bellman update for a batch of envs, duplicate entries accumulate
+        i2 = self.weights.intern_all(next_obs)
+        i1 = self.weights.intern_all(obs)
+        self.weights.reserve(max(u.max(), next_u.max()))
+        values = self.weights.values
+        current_q = values[i1, u, actions]
+        future_q = ~terminals * self.gamma * values[i2, next_u].max(axis=1)
+        td_errors = rewards + future_q - current_q
+        np.add.at(values, (i1, u, actions), self.alpha * td_errors)
+        return td_errors
 
 
 class CRMQAgent(QAgent):
+    counterfactual: ClassVar[bool] = True
+
     @override
     def update(
         self,
@@ -74,15 +145,53 @@ class CRMQAgent(QAgent):
         reward: Reward,
         next_state: State,
         terminal: bool,
-        experiences: Experiences,
+        experiences: Experiences | None,
     ) -> float:
-        # update q table for every rm state
-        td_error = 0
-        for _state, _reward, _next_state, _terminal in experiences:
-            error = super().update(_state, action, _next_state, _reward, _terminal, [])
-            if _state == state:
-                td_error = error
-        return td_error
+        # update q table for every rm state at once
+        assert experiences is not None, "Expected counterfactual experiences."
+        s1, s2, u1, u2, rewards, terminals = experiences
+        i2 = self.weights.intern(s2)
+        i1 = self.weights.intern(s1)
+        self.weights.reserve(max(u1.max(), u2.max()))
+        values = self.weights.values
+        current_q = values[i1, u1, action]
+        future_q = ~terminals * self.gamma * values[i2, u2].max(axis=1)
+        td_errors = rewards + future_q - current_q
+        values[i1, u1, action] = current_q + self.alpha * td_errors
+        return float(td_errors[u1 == state[1]][0])
+
+    @override
+    def update_batch(
+        self,
+        obs: ObsBatch,
+        u: IntVec,
+        actions: IntVec,
+        rewards: Vec,
+        next_obs: ObsBatch,
+        next_u: IntVec,
+        terminals: BoolVec,
+        experiences: Experiences | None,
+    ) -> Vec:
+        # update q table for every env and rm state at once
+        assert experiences is not None, "Expected counterfactual experiences."
+        s1, s2, u1, u2, cf_rewards, cf_terminals = experiences
+        i2 = self.weights.intern_all(s2)[:, None]
+        i1 = self.weights.intern_all(s1)[:, None]
+        self.weights.reserve(max(u1.max(), u2.max()))
+        values = self.weights.values
+        current_q = values[i1, u1, actions[:, None]]
+        future_q = ~cf_terminals * self.gamma * values[i2, u2].max(axis=2)
+        td_errors = cf_rewards + future_q - current_q
+        np.add.at(
+            values,
+            (
+                np.broadcast_to(i1, u1.shape),
+                u1,
+                np.broadcast_to(actions[:, None], u1.shape),
+            ),
+            self.alpha * td_errors,
+        )
+        return td_errors[np.arange(len(u)), np.searchsorted(u1[0], u)]
 
 
 @dataclass
@@ -95,61 +204,186 @@ class DQNAgent:
     epsilon: float = 1.0
     epsilon_decay: float = 0.995
     min_epsilon: float = 0.01
+    buffer_size: int = 0  # train online on the last transition if 0
+    batch_size: int = 32
+    target_sync: int = 0  # copy weights to the target network every n updates
+    tau: float = 0.0  # or move the target network towards them by tau per update
+    optimizer: str = "sgd"  # one of optim.OPTIMIZERS
+    dtype: DTypeLike = np.float32  # of weights, activations and state vectors
+    rng: np.random.Generator = field(default_factory=np.random.default_rng)
+    counterfactual: ClassVar[bool] = False
     w1: Mat = field(init=False)
     b1: Vec = field(init=False)
     w2: Mat = field(init=False)
     b2: Vec = field(init=False)
+    buffer: ReplayBuffer | None = field(init=False)
+    target: list[NDArray[np.floating]] | None = field(init=False)
+    n_updates: int = field(default=0, init=False)
+    optim: Optimizer = field(init=False)
 
     def __post_init__(self) -> None:
-        self.w1 = np.random.randn(self.state_dim, self.hidden_dim) * np.sqrt(
+        w1 = self.rng.standard_normal((self.state_dim, self.hidden_dim)) * np.sqrt(
             2.0 / self.state_dim
         )
-        self.b1 = np.zeros(self.hidden_dim)
-        self.w2 = np.random.randn(self.hidden_dim, self.n_actions) * np.sqrt(
+        w2 = self.rng.standard_normal((self.hidden_dim, self.n_actions)) * np.sqrt(
             2.0 / self.hidden_dim
         )
-        self.b2 = np.zeros(self.n_actions)
+        self.w1 = w1.astype(self.dtype)
+        self.b1 = np.zeros(self.hidden_dim, dtype=self.dtype)
+        self.w2 = w2.astype(self.dtype)
+        self.b2 = np.zeros(self.n_actions, dtype=self.dtype)
+        self.buffer = None
+        if self.buffer_size > 0:
+            self.buffer = ReplayBuffer(self.buffer_size, self.state_dim - 1, self.rng)
+        self.target = None
+        self._target_diff: list[NDArray[np.floating]] = []
+        if self.target_sync > 0 or self.tau > 0:
+            self.target = [p.copy() for p in self.params]
+            self._target_diff = [np.empty_like(p) for p in self.params]
+        self.optim = OPTIMIZERS[self.optimizer](self.params, self.alpha)
+        # gradients, state vectors and activations per batch size are reused
+        self._grads = [np.empty_like(p) for p in self.params]
+        self._inputs: dict[int, tuple[Mat, Mat]] = {}
+        self._scratch: dict[int, tuple[IntVec, Mat, Mat, Mat, Mat, Mat]] = {}
+
+    @property
+    def params(self) -> list[NDArray[np.floating]]:
+        return [self.w1, self.b1, self.w2, self.b2]
+
+    def _update_target(self) -> None:
+        if self.target is None:
+            return
+        self.n_updates += 1
+        if self.tau > 0:
+            # soft update: target += tau * (params - target)
+            for t, p, diff in zip(self.target, self.params, self._target_diff):
+                np.subtract(p, t, out=diff)
+                diff *= self.tau
+                t += diff
+        elif self.n_updates % self.target_sync == 0:
+            for t, p in zip(self.target, self.params):
+                np.copyto(t, p)
 
     def decay_epsilon(self) -> None:
         self.epsilon = max(self.min_epsilon, self.epsilon * self.epsilon_decay)
 
-    def _forward(self, state: Vec) -> Vec:
-        # h = np.tanh(state @ self.w1 + self.b1)
-        h = np.maximum(0, state @ self.w1 + self.b1)
-        return h @ self.w2 + self.b2
+    def _get_inputs(self, n: int) -> tuple[Mat, Mat]:
+        if n not in self._inputs:
+            self._inputs[n] = (
+                np.empty((n, self.state_dim), dtype=self.dtype),
+                np.empty((n, self.state_dim), dtype=self.dtype),
+            )
+        return self._inputs[n]
+
+    def _encode(self, obs: NDArray[np.uint8], u: IntVec | int, out: Mat) -> Mat:
+        # one row per state: observation followed by the rm state, where a
+        # single observation or rm state is broadcast over all rows
+        out[:, :-1] = obs
+        out[:, -1] = u
+        return out
+
+    def _forward(
+        self, states: Mat, params: list[NDArray[np.floating]] | None = None
+    ) -> Mat:
+        w1, b1, w2, b2 = self.params if params is None else params
+        # h = np.tanh(states @ w1 + b1)
+        h = np.maximum(0, states @ w1 + b1)
+        return h @ w2 + b2
+
+    def _get_scratch(self, n: int) -> tuple[IntVec, Mat, Mat, Mat, Mat, Mat]:
+        if n not in self._scratch:
+            self._scratch[n] = (
+                np.arange(n),
+                np.empty((n, self.hidden_dim), dtype=self.dtype),
+                np.empty((n, self.hidden_dim), dtype=self.dtype),
+                np.empty((n, self.n_actions), dtype=self.dtype),
+                np.empty((n, self.hidden_dim), dtype=self.dtype),
+                np.empty((n, self.hidden_dim), dtype=np.bool_),
+            )
+        return self._scratch[n]
 
-    def _backward(self, state: Vec, action: Action, target: float) -> float:
-        # h = np.tanh(state @ self.w1 + self.b1)
-        h_pre = state @ self.w1 + self.b1
-        h = np.maximum(0, h_pre)
-        q = h @ self.w2 + self.b2
-        q_pred = q[action]
-        error = q_pred - target
+    def _backward(
+        self, states: Mat, actions: IntVec, targets: Vec, n_samples: int | None = None
+    ) -> Vec:
+        # one optimizer step on the squared error summed over the batch and
+        # divided by n_samples, which defaults to the mean over the batch
+        if n_samples is None:
+            n_samples = len(actions)
+        rows, h_pre, h, dL_dq, dh, mask = self._get_scratch(len(actions))
+        dL_dw1, dL_db1, dL_dw2, dL_db2 = self._grads
 
-        dL_dq = np.zeros_like(q)
-        dL_dq[action] = 2 * error
+        # h = np.tanh(states @ self.w1 + self.b1)
+        np.matmul(states, self.w1, out=h_pre)
+        h_pre += self.b1
+        np.maximum(h_pre, 0, out=h)
+        q = np.matmul(h, self.w2, out=dL_dq)
+        q += self.b2
+        errors = q[rows, actions] - targets
 
-        dL_dw2 = np.outer(h, dL_dq)
-        dL_db2 = dL_dq
+        dL_dq.fill(0)
+        dL_dq[rows, actions] = errors * (2 / n_samples)
+
+        np.matmul(h.T, dL_dq, out=dL_dw2)
+        np.sum(dL_dq, axis=0, out=dL_db2)
 
         # dh = (dL_dq @ self.w2.T) * (1 - h**2)
-        dh = (dL_dq @ self.w2.T) * (h_pre > 0).astype(float)
-        dL_dw1 = np.outer(state, dh)
-        dL_db1 = dh
+        np.matmul(dL_dq, self.w2.T, out=dh)
+        np.greater(h_pre, 0, out=mask)
+        dh *= mask
+        np.matmul(states.T, dh, out=dL_dw1)
+        np.sum(dh, axis=0, out=dL_db1)
+
+        self.optim.step(self._grads)
 
-        self.w2 -= self.alpha * dL_dw2
-        self.b2 -= self.alpha * dL_db2
-        self.w1 -= self.alpha * dL_dw1
-        self.b1 -= self.alpha * dL_db1
+        return -errors
 
-        return -float(error)
+    def _train(
+        self,
+        states: Mat,
+        actions: IntVec,
+        rewards: Vec,
+        next_states: Mat,
+        terminals: BoolVec,
+        n_samples: int | None = None,
+    ) -> Vec:
+        # bootstrap from the frozen target network if there is one
+        q_next = self._forward(next_states, self.target)
+        targets = rewards + self.gamma * q_next.max(axis=1) * ~terminals
+        errors = self._backward(states, actions, targets, n_samples)
+        self._update_target()
+        return errors
 
     def get_action(self, state: State, explore: bool = False) -> int:
-        state_vec = np.array(np.append(*state), dtype=np.float64)
-        if explore and np.random.rand() < self.epsilon:
-            return np.random.randint(self.n_actions)
-        q = self._forward(state_vec)
-        return int(np.argmax(q))
+        if explore and self.rng.random() < self.epsilon:
+            return int(self.rng.integers(self.n_actions))
+        obs, u = state
+        states, _ = self._get_inputs(1)
+        q = self._forward(self._encode(obs, u, states))
+        return int(q.argmax())
+
+    def get_actions(self, obs: ObsBatch, u: IntVec, explore: bool = False) -> IntVec:
+        states, _ = self._get_inputs(len(u))
+        q = self._forward(self._encode(obs, u, states))
+        return epsilon_greedy(q, self.epsilon, explore, self.rng)
+
+    def _replay(self, newest: IntVec) -> Vec:
+        # train on the newest transitions topped up to a minibatch with random
+        # ones from the buffer, returns the errors of the newest transitions
+        assert self.buffer is not None, "Expected a replay buffer."
+        buffer = self.buffer
+        batch = newest
+        if len(newest) < self.batch_size:
+            sampled = buffer.sample(self.batch_size - len(newest))
+            batch = np.concatenate((newest, sampled))
+        states, next_states = self._get_inputs(len(batch))
+        errors = self._train(
+            self._encode(buffer.obs[batch], buffer.u[batch], states),
+            buffer.actions[batch],
+            buffer.rewards[batch],
+            self._encode(buffer.next_obs[batch], buffer.next_u[batch], next_states),
+            buffer.terminals[batch],
+        )
+        return errors[: len(newest)]
 
     def update(
         self,
@@ -158,17 +392,53 @@ class DQNAgent:
         reward: Reward,
         next_state: State,
         terminal: bool,
-        experiences: Experiences,
+        experiences: Experiences | None,
     ) -> float:
-        state_vec = np.array(np.append(*state), dtype=np.float64)
-        next_vec = np.array(np.append(*next_state), dtype=np.float64)
-        q_next = self._forward(next_vec)
-        target = reward + self.gamma * np.max(q_next) * (not terminal)
-        error = self._backward(state_vec, action, target)
-        return error
+        if self.buffer is None:
+            (s1, u1), (s2, u2) = state, next_state
+            states, next_states = self._get_inputs(1)
+            errors = self._train(
+                self._encode(s1, u1, states),
+                np.array([action]),
+                np.array([reward]),
+                self._encode(s2, u2, next_states),
+                np.array([terminal]),
+            )
+            return float(errors[0])
+
+        # the newest transition is always part of the minibatch
+        i = self.buffer.add(state, action, reward, next_state, terminal)
+        return float(self._replay(np.array([i]))[0])
+
+    def update_batch(
+        self,
+        obs: ObsBatch,
+        u: IntVec,
+        actions: IntVec,
+        rewards: Vec,
+        next_obs: ObsBatch,
+        next_u: IntVec,
+        terminals: BoolVec,
+        experiences: Experiences | None,
+    ) -> Vec:
+        if self.buffer is None:
+            states, next_states = self._get_inputs(len(u))
+            return self._train(
+                self._encode(obs, u, states),
+                actions,
+                rewards,
+                self._encode(next_obs, next_u, next_states),
+                terminals,
+            )
+        added = self.buffer.add_many(
+            obs, u, actions, rewards, next_obs, next_u, terminals
+        )
+        return self._replay(added)
 
 
 class CRMDQNAgent(DQNAgent):
+    counterfactual: ClassVar[bool] = True
+
     @override
     def update(
         self,
@@ -177,12 +447,60 @@ class CRMDQNAgent(DQNAgent):
         reward: Reward,
         next_state: State,
         terminal: bool,
-        experiences: Experiences,
+        experiences: Experiences | None,
     ) -> float:
-        # update q table for every rm state
-        td_error = 0
-        for _state, _reward, _next_state, _terminal in experiences:
-            error = super().update(_state, action, _next_state, _reward, _terminal, [])
-            if _state == state:
-                td_error = error
-        return td_error
+        # update the network on the experiences of every rm state at once,
+        # their gradients are summed so every experience takes a full step
+        # like one update per experience would
+        assert experiences is not None, "Expected counterfactual experiences."
+        s1, s2, u1, u2, rewards, terminals = experiences
+        current = int(np.searchsorted(u1, state[1]))
+        if self.buffer is None:
+            states, next_states = self._get_inputs(len(u1))
+            errors = self._train(
+                self._encode(s1, u1, states),
+                np.full(len(u1), action),
+                rewards,
+                self._encode(s2, u2, next_states),
+                terminals,
+                n_samples=1,
+            )
+            return float(errors[current])
+
+        # the newest transition of the current rm state is always sampled
+        added = self.buffer.add_batch(experiences, action)
+        return float(self._replay(added[current : current + 1])[0])
+
+    @override
+    def update_batch(
+        self,
+        obs: ObsBatch,
+        u: IntVec,
+        actions: IntVec,
+        rewards: Vec,
+        next_obs: ObsBatch,
+        next_u: IntVec,
+        terminals: BoolVec,
+        experiences: Experiences | None,
+    ) -> Vec:
+        # update the network on the experiences of every env and rm state,
+        # summed over the rm states and averaged over the envs
+        assert experiences is not None, "Expected counterfactual experiences."
+        s1, s2, u1, u2, cf_rewards, cf_terminals = experiences
+        n, k = u1.shape
+        current = np.searchsorted(u1[0], u)
+        if self.buffer is None:
+            states, next_states = self._get_inputs(n * k)
+            errors = self._train(
+                self._encode(np.repeat(s1, k, axis=0), u1.ravel(), states),
+                np.repeat(actions, k),
+                cf_rewards.ravel(),
+                self._encode(np.repeat(s2, k, axis=0), u2.ravel(), next_states),
+                cf_terminals.ravel(),
+                n_samples=n,
+            )
+            return errors.reshape(n, k)[np.arange(n), current]
+
+        # the newest transitions of the current rm states are always sampled
+        added = self.buffer.add_batch(experiences, actions).reshape(n, k)
+        return self._replay(added[np.arange(n), current])
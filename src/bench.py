@@ -0,0 +1,364 @@
+import argparse
+import itertools
+import json
+import platform
+import re
+import subprocess
+import sys
+import timeit
+from collections.abc import Callable
+from typing import NamedTuple
+
+import numpy as np
+
+from agent import CRMQAgent, DQNAgent, QAgent
+from envs.doorkey import DoorKey
+from rm import RM
+from utils import Label, Props, RMState
+
+RM_FILE = "src/envs/doorkey.txt"
+SEED = 0
+CASES = 100  # calls per timed function, results are per call
+SYNTHETIC_RMS = [(8, 4), (32, 6), (128, 8)]  # states, propositions
+HIDDEN_SIZES = [64, 256, 1024]
+BATCH_SIZE = 32
+ENV_SIZES = range(5, 17)
+VEC_ENVS = 256
+
+# function to time and the number of calls it makes
+type Benchmark = tuple[Callable[[], object], int]
+# microseconds per call by benchmark name
+type Results = dict[str, float]
+
+
+class Args(NamedTuple):
+    number: int
+    repeat: int
+    filter: str
+    output: str | None
+    compare: str | None
+    threshold: float
+
+
+def get_args() -> Args:
+    parser = argparse.ArgumentParser(
+        description="Benchmark reward machines, agents and environments."
+    )
+    _ = parser.add_argument(
+        "-n", "--number", type=int, default=20, help="calls per measurement"
+    )
+    _ = parser.add_argument(
+        "-r", "--repeat", type=int, default=5, help="number of measurements"
+    )
+    _ = parser.add_argument(
+        "-k",
+        "--filter",
+        type=str,
+        default="",
+        help="only run benchmarks whose name matches this regex",
+    )
+    _ = parser.add_argument(
+        "-o", "--output", type=str, default=None, help="json file to write results to"
+    )
+    _ = parser.add_argument(
+        "-c",
+        "--compare",
+        type=str,
+        default=None,
+        help="json file of an earlier run to compare against",
+    )
+    _ = parser.add_argument(
+        "-t",
+        "--threshold",
+        type=float,
+        default=1.1,
+        help="slowdown relative to --compare reported as regression (default: 1.1)",
+    )
+    args = parser.parse_args()
+    return Args(
+        args.number, args.repeat, args.filter, args.output, args.compare, args.threshold
+    )
+
+
+def legacy_next_state(rm: RM, u1: RMState, props: Props) -> RMState:
+    # reference: the previous implementation parsed and evaluated every formula
+    # string with eval() on every call, kept here only to compare against
+    for u2, formula in rm.delta_u[u1].items():
+        formula = re.sub(r"(?<!\w)!(\w+)", r" not \1", formula)
+        formula = re.sub(r"&", " and ", formula)
+        formula = re.sub(r"\|", " or ", formula)
+        if eval(formula, {}, props):
+            return u2
+    raise ValueError(f"No transition found for state {u1} and propositions {props}.")
+
+
+def all_props(rm: RM) -> list[Props]:
+    return [
+        dict(zip(rm.propositions, values))
+        for values in itertools.product([False, True], repeat=len(rm.propositions))
+    ]
+
+
+def synthetic_rm(n_states: int, n_props: int) -> RM:
+    # a chain of states that advances on p{u % n_props} and otherwise falls
+    # back to u0 on the next proposition, the last state is terminal
+    transitions: list[tuple[RMState, RMState, str, float]] = []
+    for u in range(n_states - 1):
+        p, q = f"p{u % n_props}", f"p{(u + 1) % n_props}"
+        transitions.append((u, u + 1, p, float(u == n_states - 2)))
+        if u == 0:
+            transitions.append((u, u, f"!{p}", 0))
+        else:
+            transitions.append((u, 0, f"!{p}&{q}", 0))
+            transitions.append((u, u, f"!{p}&!{q}", 0))
+    return RM(transitions)
+
+
+def get_cases(rm: RM, rng: np.random.Generator) -> list[tuple[RMState, Label]]:
+    # random non-terminal states with random labels
+    states = [u for u in rm.states if u not in rm.terminal_states]
+    return [
+        (int(rng.choice(states)), int(rng.integers(1 << len(rm.propositions))))
+        for _ in range(CASES)
+    ]
+
+
+def measure(func: Callable[[], object], number: int, repeat: int) -> float:
+    # best time per call in microseconds
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number * 1e6
+
+
+def bench_next_state(rm: RM) -> dict[str, Benchmark]:
+    table = RM.from_file(RM_FILE).compile(DoorKey.PROPOSITIONS)
+    cases = [(u, props) for u in rm.states for props in all_props(rm)]
+    labels = [(u, table.get_label(props)) for u, props in cases]
+    for (u, props), (_, label) in zip(cases, labels):
+        u2 = legacy_next_state(rm, u, props)
+        assert rm.get_next_state(u, props) == u2
+        assert table.get_next_state(u, props) == u2
+        assert table.get_next_state(u, label) == u2
+
+    def legacy() -> None:
+        for u, props in cases:
+            legacy_next_state(rm, u, props)
+
+    def compiled() -> None:
+        for u, props in cases:
+            rm.get_next_state(u, props)
+
+    def table_props() -> None:
+        for u, props in cases:
+            table.get_next_state(u, props)
+
+    def table_label() -> None:
+        for u, label in labels:
+            table.get_next_state(u, label)
+
+    return {
+        "rm/doorkey/next_state/legacy": (legacy, len(cases)),
+        "rm/doorkey/next_state/compiled": (compiled, len(cases)),
+        "rm/doorkey/next_state/table": (table_props, len(cases)),
+        "rm/doorkey/next_state/label": (table_label, len(cases)),
+    }
+
+
+def bench_rm(
+    name: str, rm: RM, table: RM, rng: np.random.Generator
+) -> dict[str, Benchmark]:
+    # transitions of the rm, step and counterfactual experiences of the same rm
+    # compiled to table, per call or per env of a batch
+    cases = get_cases(table, rng)
+    props = [(u, table.get_props(label)) for u, label in cases]
+    obs = np.zeros(1, dtype=np.uint8)
+    u1 = rng.choice(
+        [u for u in table.states if u not in table.terminal_states], VEC_ENVS
+    )
+    labels = rng.integers(1 << len(table.propositions), size=VEC_ENVS)
+    batch_obs = np.zeros((VEC_ENVS, 1), dtype=np.uint8)
+
+    def next_state() -> None:
+        for u, p in props:
+            rm.get_next_state(u, p)
+
+    def step() -> None:
+        for u, label in cases:
+            table.step((obs, u), obs, label)
+
+    def step_counterfactual() -> None:
+        for u, label in cases:
+            table.step((obs, u), obs, label, counterfactual=True)
+
+    def experiences() -> None:
+        for _, label in cases:
+            table.get_experiences(obs, obs, label)
+
+    def step_batch() -> None:
+        table.step_batch(batch_obs, u1, batch_obs, labels, counterfactual=True)
+
+    return {
+        f"rm/{name}/next_state": (next_state, CASES),
+        f"rm/{name}/step": (step, CASES),
+        f"rm/{name}/step_counterfactual": (step_counterfactual, CASES),
+        f"rm/{name}/get_experiences": (experiences, CASES),
+        f"rm/{name}/step_batch{VEC_ENVS}": (step_batch, VEC_ENVS),
+    }
+
+
+def rollout(rm: RM, steps: int, seed: int) -> list[tuple]:
+    # transitions of a random policy on doorkey, as passed to Agent.update
+    env = DoorKey(size=5, max_steps=250)
+    rng = np.random.default_rng(seed)
+    obs, _ = env.reset(seed=seed)
+    state = (obs, rm.reset())
+    transitions = []
+    while len(transitions) < steps:
+        action = int(rng.integers(env.n_actions))
+        next_obs, _, terminated, truncated, props = env.step(action)
+        next_state, reward, terminal, experiences = rm.step(
+            state, next_obs, props, counterfactual=True
+        )
+        transitions.append((state, action, reward, next_state, terminal, experiences))
+        state = next_state
+        if terminal or terminated or truncated:
+            obs, _ = env.reset()
+            state = (obs, rm.reset())
+    env.close()
+    return transitions
+
+
+def bench_agents(rm: RM) -> dict[str, Benchmark]:
+    transitions = rollout(rm, CASES, SEED)
+    q = QAgent(7, rng=np.random.default_rng(SEED))
+    crm = CRMQAgent(7, rng=np.random.default_rng(SEED))
+
+    def q_update() -> None:
+        for state, action, reward, next_state, terminal, _ in transitions:
+            q.update(state, action, reward, next_state, terminal, None)
+
+    def crm_update() -> None:
+        for transition in transitions:
+            crm.update(*transition)
+
+    return {
+        "agent/q/update": (q_update, CASES),
+        "agent/crmq/update": (crm_update, CASES),
+    }
+
+
+def bench_dqn(hidden_dim: int, rng: np.random.Generator) -> dict[str, Benchmark]:
+    state_dim = 1 + 2 * (5 - 2) ** 2
+    agent = DQNAgent(
+        7, state_dim, hidden_dim, optimizer="adam", rng=np.random.default_rng(SEED)
+    )
+    states = rng.integers(0, 11, (BATCH_SIZE, state_dim)).astype(agent.dtype)
+    next_states = rng.integers(0, 11, (BATCH_SIZE, state_dim)).astype(agent.dtype)
+    actions = rng.integers(7, size=BATCH_SIZE)
+    rewards = rng.random(BATCH_SIZE)
+    terminals = rng.random(BATCH_SIZE) < 0.1
+
+    def forward() -> None:
+        agent._forward(states)
+
+    def train() -> None:
+        agent._train(states, actions, rewards, next_states, terminals)
+
+    return {
+        f"dqn/h{hidden_dim}/forward{BATCH_SIZE}": (forward, 1),
+        f"dqn/h{hidden_dim}/train{BATCH_SIZE}": (train, 1),
+    }
+
+
+def bench_env(size: int, rng: np.random.Generator) -> dict[str, Benchmark]:
+    # random actions without truncation, resets only happen at the goal
+    env = DoorKey(size=size, max_steps=10**9)
+    _ = env.reset(seed=SEED)
+    actions = rng.integers(env.n_actions, size=CASES).tolist()
+
+    def step() -> None:
+        for action in actions:
+            _, _, terminated, _, _ = env.step(action)
+            if terminated:
+                _ = env.reset()
+
+    return {f"env/doorkey{size}/step": (step, CASES)}
+
+
+def get_benchmarks() -> dict[str, Benchmark]:
+    rng = np.random.default_rng(SEED)
+    rm = RM.from_file(RM_FILE)
+    benchmarks = bench_next_state(rm)
+    table = RM.from_file(RM_FILE).compile(DoorKey.PROPOSITIONS)
+    benchmarks |= bench_rm("doorkey", rm, table, rng)
+    for n_states, n_props in SYNTHETIC_RMS:
+        name = f"synthetic{n_states}x{n_props}"
+        synthetic = synthetic_rm(n_states, n_props)
+        table = synthetic_rm(n_states, n_props).compile()
+        benchmarks |= bench_rm(name, synthetic, table, rng)
+    benchmarks |= bench_agents(RM.from_file(RM_FILE).compile(DoorKey.PROPOSITIONS))
+    for hidden_dim in HIDDEN_SIZES:
+        benchmarks |= bench_dqn(hidden_dim, rng)
+    for size in ENV_SIZES:
+        benchmarks |= bench_env(size, rng)
+    return benchmarks
+
+
+def get_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main() -> None:
+    number, repeat, pattern, output, compare, threshold = get_args()
+    baseline: Results = dict()
+    if compare is not None:
+        with open(compare, "r") as file:
+            baseline = json.load(file)["results"]
+
+    results: Results = dict()
+    regressions: list[str] = []
+    benchmarks = get_benchmarks()
+    n = max(len(name) for name in benchmarks)
+    print(
+        f"{'benchmark':<{n}} | {'us/call':>9}"
+        + (" | baseline | ratio" * bool(baseline))
+    )
+    for name, (func, calls) in benchmarks.items():
+        if not re.search(pattern, name):
+            continue
+        results[name] = measure(func, number, repeat) / calls
+        line = f"{name:<{n}} | {results[name]:9.3f}"
+        if name in baseline:
+            ratio = results[name] / baseline[name]
+            line += f" | {baseline[name]:8.3f} | {ratio:5.2f}"
+            if ratio > threshold:
+                regressions.append(name)
+                line += " !"
+        print(line)
+
+    if output is not None:
+        with open(output, "w") as file:
+            json.dump(
+                {
+                    "commit": get_commit(),
+                    "python": platform.python_version(),
+                    "numpy": np.__version__,
+                    "results": results,
+                },
+                file,
+                indent=2,
+            )
+    if regressions:
+        sys.exit(
+            f"{len(regressions)} benchmarks are slower than {threshold}x baseline."
+        )
+
+
+if __name__ == "__main__":
+    main()
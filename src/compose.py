@@ -0,0 +1,285 @@
+import copy
+from collections import defaultdict, deque
+from collections.abc import Sequence
+
+import numpy as np
+
+from rm import RM
+from utils import IntMat, IntVec, Mat, Reward, RMState
+
+
+def product(rms: Sequence[RM], propositions: Sequence[str] | None = None) -> RM:
+    # all machines step together and the product ends once all of them have
+    # ended, the reward is the sum of their rewards
+    return compose(rms, propositions, sequential=False, any_terminal=False)
+
+
+def union(rms: Sequence[RM], propositions: Sequence[str] | None = None) -> RM:
+    # like product but ends as soon as one of the machines has ended
+    return compose(rms, propositions, sequential=False, any_terminal=True)
+
+
+def sequence(rms: Sequence[RM], propositions: Sequence[str] | None = None) -> RM:
+    # one machine after the other, a machine starts in its initial state on
+    # the step after the previous one has ended
+    return compose(rms, propositions, sequential=True, any_terminal=False)
+
+
+def compose(
+    rms: Sequence[RM],
+    propositions: Sequence[str] | None = None,
+    sequential: bool = False,
+    any_terminal: bool = False,
+) -> RM:
+    # builds the joint machine over tuples of component states reachable from
+    # the initial tuple, which becomes state 0, and compiles it to a single
+    # table over the shared propositions, every joint edge is labeled with the
+    # conjunction of the formulas under which the component edges it takes
+    # fire
+    assert len(rms) != 0, "Expected at least one RM."
+    if propositions is None:
+        propositions = sorted(set().union(*(rm.propositions for rm in rms)))
+    tables = [copy.copy(rm).compile(propositions) for rm in rms]
+    n_labels = 1 << len(propositions)
+
+    def is_terminal(joint: tuple[RMState, ...]) -> bool:
+        ended = [rm.terminal_table[u] for rm, u in zip(tables, joint)]
+        return any(ended) if any_terminal else all(ended)
+
+    initial = tuple(rm.initial_state for rm in tables)
+    if is_terminal(initial):
+        raise ValueError("Invalid composition: the initial state is terminal.")
+    index: dict[tuple[RMState, ...], RMState] = {initial: 0}
+    queue = deque([initial])
+    transitions: list[tuple[RMState, RMState, str, Reward]] = []
+    expected: dict[RMState, IntVec] = {}
+
+    while queue:
+        joint = queue.popleft()
+        active = [
+            i
+            for i, (rm, u) in enumerate(zip(tables, joint))
+            if not rm.terminal_table[u]
+        ]
+        if sequential:
+            active = active[:1]
+        # next component states for every label, one column per label
+        next_joints = np.repeat(np.array(joint)[:, None], n_labels, axis=1)
+        for i in active:
+            next_joints[i] = tables[i].next_state_table[joint[i]]
+        if np.any(next_joints < 0):
+            raise ValueError(f"Invalid composition: no transition from {joint}.")
+
+        columns, inverse = np.unique(next_joints.T, axis=0, return_inverse=True)
+        next_states: list[RMState] = []
+        for column in columns:
+            next_joint = tuple(int(u) for u in column)
+            if next_joint not in index:
+                index[next_joint] = len(index)
+                if not is_terminal(next_joint):
+                    queue.append(next_joint)
+            next_states.append(index[next_joint])
+            formula = "&".join(
+                f"({get_firing_formula(tables[i], joint[i], next_joint[i])})"
+                for i in active
+            )
+            reward = sum(tables[i].delta_r[joint[i]][next_joint[i]] for i in active)
+            transitions.append((index[joint], index[next_joint], formula, reward))
+        expected[index[joint]] = np.array(next_states)[inverse.ravel()]
+
+    return build(transitions, propositions, expected)
+
+
+def minimize(rm: RM) -> tuple[RM, dict[RMState, RMState]]:
+    # drops states unreachable from the initial state and merges states with
+    # the same future rewards for every sequence of labels by partition
+    # refinement, returns the minimal machine and the state every reachable
+    # state of rm is merged into
+    table = rm if rm.compiled else copy.copy(rm).compile()
+    # missing transitions lead to an extra state that stays in block -1
+    n_states = len(table.next_state_table)
+    next_table = np.where(table.next_state_table < 0, n_states, table.next_state_table)
+
+    reachable = np.zeros(n_states + 1, dtype=np.bool_)
+    reachable[table.initial_state] = True
+    queue = deque([table.initial_state])
+    while queue:
+        for u in np.unique(next_table[queue.popleft()]).tolist():
+            if u < n_states and not reachable[u]:
+                reachable[u] = True
+                queue.append(u)
+    states = np.flatnonzero(reachable)
+
+    # terminal states start in one block as they all end the episode
+    blocks = np.full(n_states + 1, -1, dtype=np.int64)
+    blocks[states] = table.terminal_table[states]
+    while True:
+        blocks = refine(next_table, table.reward_table, states, blocks)
+        if not split_rewards(next_table, table.reward_table, states, blocks):
+            break
+
+    # merged states are numbered by their first member, terminal ones last,
+    # which keeps the numbers of an already minimal machine
+    representatives: dict[int, RMState] = {}
+    for u in sorted(states.tolist(), key=lambda u: (table.terminal_table[u], u)):
+        representatives.setdefault(int(blocks[u]), u)
+    index = {block: i for i, block in enumerate(representatives)}
+
+    transitions: list[tuple[RMState, RMState, str, Reward]] = []
+    expected: dict[RMState, IntVec] = {}
+    for block, u in representatives.items():
+        if table.terminal_table[u]:
+            continue
+        targets: dict[int, list[RMState]] = defaultdict(list)
+        for v in np.unique(next_table[u]).tolist():
+            if v < n_states:
+                targets[int(blocks[v])].append(v)
+        for target, vs in targets.items():
+            # the firing formulas of the edges of a state exclude each other,
+            # so their disjunction does not depend on the order of the edges
+            formulas = [get_firing_formula(table, u, v) for v in vs]
+            formula = (
+                formulas[0] if len(vs) == 1 else "|".join(f"({f})" for f in formulas)
+            )
+            reward = table.delta_r[u][vs[0]]
+            transitions.append((index[block], index[target], formula, reward))
+        expected[index[block]] = np.array(
+            [index.get(int(b), -1) for b in blocks[next_table[u]]]
+        )
+
+    mapping = {int(u): index[int(blocks[u])] for u in states}
+    return build(transitions, table.propositions, expected), mapping
+
+
+def refine(
+    next_table: IntMat, reward_table: Mat, states: IntVec, blocks: IntVec
+) -> IntVec:
+    # splits blocks until the states of every block move to the same blocks
+    # with the same rewards under every label
+    n_blocks = len(np.unique(blocks[states]))
+    while True:
+        next_blocks = blocks[next_table[states]]
+        signatures = np.column_stack(
+            [blocks[states], next_blocks, reward_table[states]]
+        )
+        _, inverse = np.unique(signatures, axis=0, return_inverse=True)
+        blocks = blocks.copy()
+        blocks[states] = inverse.ravel()
+        if inverse.max() + 1 == n_blocks:
+            return blocks
+        n_blocks = inverse.max() + 1
+
+
+def split_rewards(
+    next_table: IntMat, reward_table: Mat, states: IntVec, blocks: IntVec
+) -> bool:
+    # a state that moves into one block with different rewards can not be
+    # written as a single edge, so its successors in that block are split by
+    # those rewards, the other members stay with the first reward. only the
+    # successors that fire under some label count, shadowed edges never do
+    n_states = len(reward_table)
+    for u in states.tolist():
+        successors: dict[int, dict[Reward, list[RMState]]] = defaultdict(
+            lambda: defaultdict(list)
+        )
+        next_states, labels = np.unique(next_table[u], return_index=True)
+        for v, label in zip(next_states.tolist(), labels.tolist()):
+            if v < n_states:
+                reward = reward_table[u, label].item()
+                successors[int(blocks[v])][reward].append(v)
+        for by_reward in successors.values():
+            if len(by_reward) > 1:
+                last = blocks.max()
+                rewards = sorted(by_reward, key=str)
+                for key, reward in enumerate(rewards[1:], 1):
+                    blocks[by_reward[reward]] = last + key
+                return True
+    return False
+
+
+def get_firing_formula(rm: RM, u1: RMState, u2: RMState) -> str:
+    # the formula under which the edge from u1 to u2 is taken, as the first
+    # matching edge is taken it must match and none of the edges before it
+    earlier: list[str] = []
+    for u, formula in rm.delta_u[u1].items():
+        if u == u2:
+            return "&".join([f"({formula})", *(f"!({f})" for f in earlier)])
+        earlier.append(formula)
+    raise ValueError(f"No transition from state {u1} to {u2}.")
+
+
+def build(
+    transitions: list[tuple[RMState, RMState, str, Reward]],
+    propositions: Sequence[str],
+    expected: dict[RMState, IntVec],
+) -> RM:
+    # compiles the built machine and checks it against the next states it
+    # was built from, which differ if the source machines had overlapping
+    # formulas
+    built = RM(transitions).compile(propositions)
+    for u, next_states in expected.items():
+        if not np.array_equal(built.next_state_table[u], next_states):
+            raise ValueError(
+                "Invalid RM: overlapping formulas in a non-deterministic RM."
+            )
+    return built
+
+
+def validate() -> int:
+    # checks minimize on machines with a known minimal form, returns the
+    # number of checked machines
+    cases: list[tuple[list[tuple[RMState, RMState, str, Reward]], dict[int, int]]] = [
+        # terminal 3 is only ever entered with reward 0 like terminal 1, so
+        # only terminal 2 is split off by its reward
+        (
+            [
+                (0, 1, "a", 0),
+                (0, 2, "!a&b", 1),
+                (0, 5, "!a&!b", 0),
+                (5, 3, "a", 0),
+                (5, 5, "!a", 0),
+            ],
+            {0: 0, 5: 1, 1: 2, 3: 2, 2: 3},
+        ),
+        # equivalent chains are merged and the unreachable state 4 is dropped
+        (
+            [
+                (0, 1, "a", 0),
+                (0, 0, "!a", 0),
+                (1, 2, "a", 1),
+                (1, 1, "!a", 0),
+                (4, 2, "a", 1),
+                (4, 4, "!a", 0),
+            ],
+            {0: 0, 1: 1, 2: 2},
+        ),
+        # the edge into terminal 2 with reward 1 is shadowed by the one into
+        # terminal 1, so it does not split the two terminals
+        (
+            [
+                (0, 1, "a", 0),
+                (0, 2, "a", 1),
+                (0, 3, "!a", 0),
+                (3, 2, "a|!a", 1),
+            ],
+            {0: 0, 3: 1, 1: 2, 2: 2},
+        ),
+        # the edge into 3 overlaps the one into 1 before it, which it merges
+        # with as 1 and 3 are equivalent
+        (
+            [
+                (0, 1, "a", 0),
+                (0, 3, "a|b", 0),
+                (0, 0, "!a&!b", 0),
+                (1, 2, "c", 1),
+                (1, 1, "!c", 0),
+                (3, 2, "c", 1),
+                (3, 3, "!c", 0),
+            ],
+            {0: 0, 1: 1, 3: 1, 2: 2},
+        ),
+    ]
+    for transitions, expected in cases:
+        _, mapping = minimize(RM(transitions))
+        assert mapping == expected, f"Expected {expected}, got {mapping}."
+    return len(cases)
@@ -1,3 +1,4 @@
+from collections.abc import Callable, Iterator, Mapping
 from typing import Any, Protocol
 
 from utils import Action, Observation, Props, Reward
@@ -12,3 +13,34 @@ class Env(Protocol):
     def step(self, action: Action) -> tuple[Observation, Reward, bool, bool, Props]: ...
     def close(self) -> None: ...
     def render(self) -> None: ...
+
+
+class LazyProps[T](Mapping[str, T]):
+    # propositions of a step that are computed on first access by the
+    # detectors of the env, so the RM only pays for the propositions of its
+    # current state, the env expires them on its next step as the detectors
+    # read its current state
+    def __init__(
+        self, detectors: Mapping[str, Callable[[], T]], values: dict[str, T]
+    ) -> None:
+        self.detectors: Mapping[str, Callable[[], T]] | None = detectors
+        self.cache: dict[str, T] = values
+        self.names: list[str] = [*values, *(p for p in detectors if p not in values)]
+
+    def __getitem__(self, p: str) -> T:
+        if p not in self.cache:
+            if self.detectors is None:
+                raise ValueError(
+                    f"ERROR: Proposition '{p}' read after the next step of the env."
+                )
+            self.cache[p] = self.detectors[p]()
+        return self.cache[p]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.names)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def expire(self) -> None:
+        self.detectors = None
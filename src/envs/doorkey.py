@@ -1,50 +1,101 @@
+from collections.abc import Callable
 from typing import Any, override
 
 import numpy as np
+from gymnasium import spaces
 from minigrid.core.constants import OBJECT_TO_IDX
 from minigrid.core.world_object import Door, Key
 from minigrid.envs.doorkey import DoorKeyEnv
 
+from env import LazyProps
 from utils import Action, Observation, Props, Reward
 
+EMPTY: tuple[int, int] = (OBJECT_TO_IDX["empty"], 0)
+
 
 class DoorKey(DoorKeyEnv):
+    # proposition order of the labels, bit i is set if proposition i holds
+    PROPOSITIONS: tuple[str, ...] = ("door", "key", "terminated", "truncated")
+
     def __init__(
-        self, size: int = 5, max_steps: int | None = 250, **kwargs: Any
+        self,
+        size: int = 5,
+        max_steps: int | None = 250,
+        rng: np.random.Generator | None = None,
+        **kwargs: Any,
     ) -> None:
         super().__init__(size, max_steps, **kwargs)
+        # grids are drawn from rng until a reset with an explicit seed
+        if rng is not None:
+            self.np_random = rng
         self.n_actions: int = self.action_space.n
+        # the flat observation of get_obs instead of minigrid's partial view
+        self.observation_space = spaces.Box(
+            low=0,
+            high=max(OBJECT_TO_IDX.values()),
+            shape=((size - 2) ** 2 * 2,),
+            dtype=np.uint8,
+        )
+        # cached at reset, the observation is only patched where cells change
+        self.door: Door | None = None
+        self.detectors: dict[str, Callable[[], bool]] = {
+            "door": self.door_is_open,
+            "key": self.has_key,
+        }
+        self.props: LazyProps[bool] | None = None
+        self.obs: Observation = np.zeros((size - 2, size - 2, 2), dtype=np.uint8)
 
-    def door_is_open(self) -> bool:
-        for x in range(self.grid.width):
-            for y in range(self.grid.height):
-                cell = self.grid.get(x, y)
-                if isinstance(cell, Door):
-                    return cell.is_open
+    def find_door(self) -> Door:
+        for cell in self.grid.grid:
+            if isinstance(cell, Door):
+                return cell
         raise ValueError(
             "ERROR: Unreachable! Door should always be generated by DoorKeyEnv._gen_grid."
         )
 
+    def door_is_open(self) -> bool:
+        assert self.door is not None, "Expected reset before use."
+        return self.door.is_open
+
+    def has_key(self) -> bool:
+        return isinstance(self.carrying, Key)
+
     def get_obs(self) -> Observation:
+        return self.obs.reshape(self.obs.size).copy()
+
+    def encode_obs(self) -> None:
         obs = np.delete(self.grid.encode(), 1, axis=2)
         obs[self.agent_pos][0] = OBJECT_TO_IDX["agent"]
         obs[self.agent_pos][1] = self.agent_dir
-        obs = obs[1:-1, 1:-1, :]
-        return obs.reshape(obs.size)
+        self.obs[:] = obs[1:-1, 1:-1, :]
+
+    def encode_cell(self, x: int, y: int) -> None:
+        if not (0 < x < self.width - 1 and 0 < y < self.height - 1):
+            return  # the outer walls are not observed
+        cell = self.grid.get(x, y)
+        self.obs[x - 1, y - 1] = EMPTY if cell is None else cell.encode()[::2]
+
+    @override
+    def gen_obs(self) -> dict[str, Any]:
+        # minigrid's partial view is not used, see get_obs
+        return {}
 
     def get_props(self, terminated: bool, truncated: bool) -> Props:
-        return {
-            "door": self.door_is_open(),
-            "key": isinstance(self.carrying, Key),
-            "terminated": terminated,
-            "truncated": truncated,
-        }
+        # door and key are only detected when read, see env.LazyProps
+        if self.props is not None:
+            self.props.expire()
+        self.props = LazyProps(
+            self.detectors, {"terminated": terminated, "truncated": truncated}
+        )
+        return self.props
 
     @override
     def reset(
         self, *, seed: int | None = None, options: dict[str, Any] | None = None
     ) -> tuple[Observation, Props]:
         _ = super().reset(seed=seed, options=options)
+        self.door = self.find_door()
+        self.encode_obs()
         obs = self.get_obs()
         props = {
             "door": False,
@@ -57,7 +108,15 @@ class DoorKey(DoorKeyEnv):
 
     @override
     def step(self, action: Action) -> tuple[Observation, Reward, bool, bool, Props]:
+        agent_pos, front_pos = self.agent_pos, self.front_pos
         _, _, terminated, truncated, _ = super().step(action)
+
+        # only the cell the agent left and the cell it acted on can change
+        self.encode_cell(*agent_pos)
+        if action in (self.actions.pickup, self.actions.drop, self.actions.toggle):
+            self.encode_cell(*front_pos)
+        x, y = self.agent_pos
+        self.obs[x - 1, y - 1] = (OBJECT_TO_IDX["agent"], self.agent_dir)
         obs = self.get_obs()
         reward = 1.0 if terminated else 0.0
         return (
@@ -0,0 +1,218 @@
+from collections.abc import Callable
+from typing import Any
+
+import numpy as np
+from numpy.typing import NDArray
+
+from env import LazyProps
+from utils import BoolVec, IntVec, Vec
+
+# object and state indices as encoded by minigrid
+EMPTY, WALL, DOOR, KEY, GOAL, AGENT = 1, 2, 4, 5, 8, 10
+OPEN, CLOSED, LOCKED = 0, 1, 2
+
+# actions as in minigrid.core.actions.Actions
+LEFT, RIGHT, FORWARD, PICKUP, DROP, TOGGLE, DONE = range(7)
+
+# action distribution of validate, biased to forward so the goal gets reached
+VALIDATION_ACTIONS = [0.15, 0.15, 0.35, 0.12, 0.08, 0.12, 0.03]
+
+# forward movement per agent direction: right, down, left, up
+DIR_TO_DX = np.array([1, 0, -1, 0])
+DIR_TO_DY = np.array([0, 1, 0, -1])
+
+
+class VecDoorKey:
+    # n copies of envs.doorkey.DoorKey stepped at once, where the grid of every
+    # env is kept as an integer array of (type, state) cells in the layout of
+    # minigrid's Grid.encode without the color channel
+
+    PROPOSITIONS: tuple[str, ...] = ("door", "key", "terminated", "truncated")
+
+    def __init__(
+        self,
+        n_envs: int = 1,
+        size: int = 5,
+        max_steps: int = 250,
+        rng: np.random.Generator | None = None,
+    ) -> None:
+        self.n_envs: int = n_envs
+        self.size: int = size
+        self.max_steps: int = max_steps
+        self.n_actions: int = 7
+        # every env draws its grids from an independent child stream of rng
+        if rng is None:
+            rng = np.random.default_rng()
+        self.rngs: list[np.random.Generator] = rng.spawn(n_envs)
+
+        self.cells: NDArray[np.uint8] = np.zeros(
+            (n_envs, size, size, 2), dtype=np.uint8
+        )
+        self.agent_x: IntVec = np.zeros(n_envs, dtype=np.int64)
+        self.agent_y: IntVec = np.zeros(n_envs, dtype=np.int64)
+        self.agent_dir: IntVec = np.zeros(n_envs, dtype=np.int64)
+        self.door_x: IntVec = np.zeros(n_envs, dtype=np.int64)
+        self.door_y: IntVec = np.zeros(n_envs, dtype=np.int64)
+        self.carrying: BoolVec = np.zeros(n_envs, dtype=np.bool_)
+        self.step_count: IntVec = np.zeros(n_envs, dtype=np.int64)
+        self._envs: IntVec = np.arange(n_envs)
+        self.detectors: dict[str, Callable[[], BoolVec]] = {
+            "door": self.door_is_open,
+            "key": self.carrying.copy,
+        }
+        self.props: LazyProps[BoolVec] | None = None
+
+    def _gen_grid(self, i: int) -> None:
+        # same layout and sequence of random draws as DoorKeyEnv._gen_grid
+        rng = self.rngs[i]
+        size = self.size
+        cells = self.cells[i]
+        cells[:] = (EMPTY, 0)
+        cells[[0, -1], :] = (WALL, 0)
+        cells[:, [0, -1]] = (WALL, 0)
+        cells[size - 2, size - 2] = (GOAL, 0)
+
+        split = int(rng.integers(2, size - 2))
+        cells[split, :] = (WALL, 0)
+
+        x, y = self._place(i, split, (-1, -1))
+        self.agent_x[i], self.agent_y[i] = x, y
+        self.agent_dir[i] = rng.integers(0, 4)
+
+        door = int(rng.integers(1, size - 2))
+        cells[split, door] = (DOOR, LOCKED)
+        self.door_x[i], self.door_y[i] = split, door
+
+        key_x, key_y = self._place(i, split, (x, y))
+        cells[key_x, key_y] = (KEY, 0)
+
+    def _place(self, i: int, width: int, agent: tuple[int, int]) -> tuple[int, int]:
+        # rejection sampling of an empty cell left of the wall as in place_obj
+        rng = self.rngs[i]
+        while True:
+            x = int(rng.integers(0, width))
+            y = int(rng.integers(0, self.size))
+            if self.cells[i, x, y, 0] == EMPTY and (x, y) != agent:
+                return x, y
+
+    def reset_envs(self, envs: IntVec) -> None:
+        for i in envs.tolist():
+            self._gen_grid(i)
+        self.carrying[envs] = False
+        self.step_count[envs] = 0
+
+    def reset(
+        self, *, seed: int | None = None, options: dict[str, Any] | None = None
+    ) -> tuple[NDArray[np.uint8], LazyProps[BoolVec]]:
+        # env i is seeded with seed + i like gymnasium's vector envs
+        if seed is not None:
+            self.rngs = [np.random.default_rng(seed + i) for i in range(self.n_envs)]
+        self.reset_envs(self._envs)
+        no = np.zeros(self.n_envs, dtype=np.bool_)
+        return self.get_obs(), self.get_props(no, no)
+
+    def door_is_open(self) -> BoolVec:
+        return self.cells[self._envs, self.door_x, self.door_y, 1] == OPEN
+
+    def get_obs(self) -> NDArray[np.uint8]:
+        obs = self.cells[:, 1:-1, 1:-1].copy()
+        obs[self._envs, self.agent_x - 1, self.agent_y - 1, 0] = AGENT
+        obs[self._envs, self.agent_x - 1, self.agent_y - 1, 1] = self.agent_dir
+        return obs.reshape(self.n_envs, -1)
+
+    def get_props(self, terminated: BoolVec, truncated: BoolVec) -> LazyProps[BoolVec]:
+        # door and key are only detected when read, see env.LazyProps
+        if self.props is not None:
+            self.props.expire()
+        self.props = LazyProps(
+            self.detectors, {"terminated": terminated, "truncated": truncated}
+        )
+        return self.props
+
+    def step(
+        self, actions: IntVec
+    ) -> tuple[NDArray[np.uint8], Vec, BoolVec, BoolVec, LazyProps[BoolVec]]:
+        # same dynamics as MiniGridEnv.step on every env at once
+        envs = self._envs
+        self.step_count += 1
+
+        fwd_x = self.agent_x + DIR_TO_DX[self.agent_dir]
+        fwd_y = self.agent_y + DIR_TO_DY[self.agent_dir]
+        fwd_type = self.cells[envs, fwd_x, fwd_y, 0]
+        fwd_state = self.cells[envs, fwd_x, fwd_y, 1]
+
+        self.agent_dir = (self.agent_dir + (actions == RIGHT) - (actions == LEFT)) % 4
+
+        forward = actions == FORWARD
+        can_overlap = (
+            (fwd_type == EMPTY)
+            | (fwd_type == GOAL)
+            | ((fwd_type == DOOR) & (fwd_state == OPEN))
+        )
+        move = forward & can_overlap
+        self.agent_x[move] = fwd_x[move]
+        self.agent_y[move] = fwd_y[move]
+        terminated = forward & (fwd_type == GOAL)
+
+        pickup = (actions == PICKUP) & (fwd_type == KEY) & ~self.carrying
+        self.cells[envs[pickup], fwd_x[pickup], fwd_y[pickup], 0] = EMPTY
+        drop = (actions == DROP) & (fwd_type == EMPTY) & self.carrying
+        self.cells[envs[drop], fwd_x[drop], fwd_y[drop], 0] = KEY
+        self.carrying ^= pickup | drop
+
+        # a locked door opens with the key, otherwise the door opens or closes
+        toggle = (actions == TOGGLE) & (fwd_type == DOOR)
+        toggle &= (fwd_state != LOCKED) | self.carrying
+        self.cells[envs[toggle], fwd_x[toggle], fwd_y[toggle], 1] = np.where(
+            fwd_state[toggle] == OPEN, CLOSED, OPEN
+        )
+
+        truncated = self.step_count >= self.max_steps
+        rewards = terminated.astype(np.float64)
+        return (
+            self.get_obs(),
+            rewards,
+            terminated,
+            truncated,
+            self.get_props(terminated, truncated),
+        )
+
+    def close(self) -> None:
+        pass
+
+
+def validate(
+    size: int = 5, episodes: int = 100, seed: int = 0, max_steps: int = 250
+) -> int:
+    # step DoorKey and VecDoorKey with the same random actions and compare
+    # every transition, returns the number of compared steps
+    from envs.doorkey import DoorKey
+
+    env = DoorKey(size=size, max_steps=max_steps)
+    vec_env = VecDoorKey(1, size=size, max_steps=max_steps)
+    rng = np.random.default_rng(seed)
+    obs, props = env.reset(seed=seed)
+    vec_obs, vec_props = vec_env.reset(seed=seed)
+    steps = 0
+
+    for episode in range(episodes):
+        terminal = False
+        while not terminal:
+            assert np.array_equal(obs, vec_obs[0]), f"Observation differs at {steps}."
+            for p in VecDoorKey.PROPOSITIONS:
+                assert props[p] == vec_props[p][0], f"'{p}' differs at {steps}."
+            action = int(rng.choice(env.n_actions, p=VALIDATION_ACTIONS))
+            obs, reward, terminated, truncated, props = env.step(action)
+            vec_obs, vec_reward, vec_terminated, vec_truncated, vec_props = (
+                vec_env.step(np.array([action]))
+            )
+            assert reward == vec_reward[0], f"Reward differs at {steps}."
+            assert terminated == vec_terminated[0], f"Termination differs at {steps}."
+            assert truncated == vec_truncated[0], f"Truncation differs at {steps}."
+            terminal = terminated or truncated
+            steps += 1
+        obs, props = env.reset()
+        vec_obs, vec_props = vec_env.reset()
+
+    env.close()
+    return steps
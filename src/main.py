@@ -1,3 +1,5 @@
+import numpy as np
+
 from agent import DQNAgent
 from envs.doorkey import DoorKey
 from rm import RM
@@ -6,6 +8,10 @@ from train import test, train
 ENV_SIZE = 5
 STATE_DIM = 1 + 2 * (ENV_SIZE - 2) ** 2
 HIDDEN_DIM = 256
+BUFFER_SIZE = 10000
+BATCH_SIZE = 32
+TARGET_SYNC = 500
+OPTIMIZER = "adam"
 MAX_STEPS = 250
 SEED = 0
 EPISODES = 1000
@@ -18,18 +24,26 @@ EPSILON_DECAY: float = (MIN_EPSILON / EPSILON) ** (1 / EPISODES)
 
 
 def main() -> None:
-    env = DoorKey(size=ENV_SIZE, max_steps=MAX_STEPS)
+    agent_seed, env_seed = np.random.SeedSequence(SEED).spawn(2)
+    env = DoorKey(
+        size=ENV_SIZE, max_steps=MAX_STEPS, rng=np.random.default_rng(env_seed)
+    )
     rm = None
-    rm = RM.from_file("src/envs/doorkey.txt")
+    rm = RM.load("src/envs/doorkey.txt", DoorKey.PROPOSITIONS)
     agent = DQNAgent(
         n_actions=env.n_actions,
         state_dim=STATE_DIM,
         hidden_dim=HIDDEN_DIM,
+        buffer_size=BUFFER_SIZE,
+        batch_size=BATCH_SIZE,
+        target_sync=TARGET_SYNC,
+        optimizer=OPTIMIZER,
         alpha=ALPHA,
         gamma=GAMMA,
         epsilon=EPSILON,
         epsilon_decay=EPSILON_DECAY,
         min_epsilon=MIN_EPSILON,
+        rng=np.random.default_rng(agent_seed),
     )
 
     print("Started training:")
@@ -0,0 +1,119 @@
+from collections.abc import Callable
+from dataclasses import dataclass, field
+from typing import Protocol
+
+import numpy as np
+from numpy.typing import NDArray
+
+type Params = list[NDArray[np.floating]]
+
+
+class Optimizer(Protocol):
+    # updates params in place, grads may be overwritten as scratch space
+    def step(self, grads: Params) -> None: ...
+
+
+@dataclass
+class SGD:
+    params: Params
+    lr: float
+
+    def step(self, grads: Params) -> None:
+        for p, g in zip(self.params, grads):
+            g *= self.lr
+            p -= g
+
+
+@dataclass
+class Momentum:
+    params: Params
+    lr: float
+    beta: float = 0.9
+    velocity: Params = field(init=False)
+
+    def __post_init__(self) -> None:
+        self.velocity = [np.zeros_like(p) for p in self.params]
+
+    def step(self, grads: Params) -> None:
+        for p, g, v in zip(self.params, grads, self.velocity):
+            v *= self.beta
+            v += g
+            np.multiply(v, self.lr, out=g)
+            p -= g
+
+
+@dataclass
+class RMSProp:
+    params: Params
+    lr: float
+    rho: float = 0.99
+    eps: float = 1e-8
+    square_avg: Params = field(init=False)
+    scratch: Params = field(init=False)
+
+    def __post_init__(self) -> None:
+        self.square_avg = [np.zeros_like(p) for p in self.params]
+        self.scratch = [np.empty_like(p) for p in self.params]
+
+    def step(self, grads: Params) -> None:
+        for p, g, s, tmp in zip(self.params, grads, self.square_avg, self.scratch):
+            # s = rho * s + (1 - rho) * g^2
+            np.multiply(g, g, out=tmp)
+            tmp *= 1 - self.rho
+            s *= self.rho
+            s += tmp
+            # p -= lr * g / (sqrt(s) + eps)
+            np.sqrt(s, out=tmp)
+            tmp += self.eps
+            np.divide(g, tmp, out=tmp)
+            tmp *= self.lr
+            p -= tmp
+
+
+@dataclass
+class Adam:
+    params: Params
+    lr: float
+    beta1: float = 0.9
+    beta2: float = 0.999
+    eps: float = 1e-8
+    t: int = field(default=0, init=False)
+    m: Params = field(init=False)
+    v: Params = field(init=False)
+    scratch: Params = field(init=False)
+
+    def __post_init__(self) -> None:
+        self.m = [np.zeros_like(p) for p in self.params]
+        self.v = [np.zeros_like(p) for p in self.params]
+        self.scratch = [np.empty_like(p) for p in self.params]
+
+    def step(self, grads: Params) -> None:
+        self.t += 1
+        # fold the bias corrections into the step size and epsilon
+        correction = (1 - self.beta2**self.t) ** 0.5
+        step_size = self.lr * correction / (1 - self.beta1**self.t)
+        eps = self.eps * correction
+        for p, g, m, v, tmp in zip(self.params, grads, self.m, self.v, self.scratch):
+            # m = beta1 * m + (1 - beta1) * g
+            m *= self.beta1
+            np.multiply(g, 1 - self.beta1, out=tmp)
+            m += tmp
+            # v = beta2 * v + (1 - beta2) * g^2
+            v *= self.beta2
+            np.multiply(g, g, out=tmp)
+            tmp *= 1 - self.beta2
+            v += tmp
+            # p -= step_size * m / (sqrt(v) + eps)
+            np.sqrt(v, out=tmp)
+            tmp += eps
+            np.divide(m, tmp, out=tmp)
+            tmp *= step_size
+            p -= tmp
+
+
+OPTIMIZERS: dict[str, Callable[[Params, float], Optimizer]] = {
+    "sgd": SGD,
+    "momentum": Momentum,
+    "rmsprop": RMSProp,
+    "adam": Adam,
+}
@@ -1,11 +1,27 @@
 import argparse
+import hashlib
 import json
+import os
+from collections.abc import Callable
+from concurrent.futures import ProcessPoolExecutor
 from typing import NamedTuple
 
 import numpy as np
 import scienceplots
 from matplotlib import pyplot as plt
 
+from results import (
+    METRICS,
+    Aggregate,
+    aggregate,
+    fingerprint,
+    get_filenames,
+    get_timings_filename,
+    load,
+    load_timings,
+)
+from timing import PHASES
+
 scienceplots.__path__  # so import is not removed by formatter
 plt.style.use(["science", "bright"])
 plt.rcParams.update(
@@ -25,31 +41,19 @@ ALGS = {
     "crm2": ("C4", "CRM tuned"),
 }
 
-
-class Run(NamedTuple):
-    errors: list[float]
-    rewards: list[float]
-    steps: list[int]
-    tests: int
-
-
-Data = dict[str, list[Run]]
-
-
-class Avg(NamedTuple):
-    errors: list[float]
-    rewards: list[float]
-    steps: list[int]
-    tests: list[int]
+# aggregates and fingerprints of rendered figures are kept here in the folder
+CACHE = "cache"
 
 
-Avgs = dict[str, Avg]
+Avgs = dict[str, Aggregate]
 
 
 class Args(NamedTuple):
     runs: int
     size: int
     folder: str
+    force: bool
+    bands: bool
 
 
 def get_args() -> Args:
@@ -71,35 +75,53 @@ def get_args() -> Args:
         default="data",
         help="folder that the data is stored in",
     )
+    _ = parser.add_argument(
+        "--force",
+        action="store_true",
+        help="aggregate the data and render all figures even if unchanged",
+    )
+    _ = parser.add_argument(
+        "--bands",
+        action="store_true",
+        help="shade the 95%% confidence intervals of the means",
+    )
     args = parser.parse_args()
-    return Args(args.runs, args.size, args.folder)
+    return Args(args.runs, args.size, args.folder, args.force, args.bands)
 
 
-def get_data(folder: str, runs: int, size: int) -> Data:
-    data: Data = {alg: list() for alg in ALGS}
-    for alg in ALGS:
-        for i in range(runs):
-            with open(f"{folder}/{alg}_{size}x{size}_{i+1}.json", "r") as file:
-                loaded: tuple[list[float], list[float], list[int], int] = json.load(
-                    file
-                )
-            data[alg].append(Run(*loaded))
-    return data
+def get_cached_avg(
+    folder: str, alg: str, size: int, runs: int, key: str, force: bool = False
+) -> Aggregate:
+    filename = f"{folder}/{CACHE}/{alg}_{size}x{size}_{runs}.npz"
+    if not force and os.path.exists(filename):
+        avg = Aggregate.load(filename, key)
+        if avg is not None:
+            return avg
+    avg = aggregate(folder, alg, size, runs)
+    avg.save(filename, key)
+    return avg
 
 
 def get_avgs(
-    data: Data,
+    folder: str, runs: int, size: int, keys: dict[str, str], force: bool = False
 ) -> Avgs:
-    dir: Avgs = dict()
-    for alg, runs in data.items():
-        errors: list[float] = np.mean([run.errors for run in runs], axis=0)
-        rewards: list[float] = np.mean([run.rewards for run in runs], axis=0)
-        steps: list[int] = np.mean([run.steps for run in runs], axis=0)
-        dir[alg] = Avg(errors, rewards, steps, [run.tests for run in runs])
-    return dir
-
-
-def calc_convergence(avg: Avg) -> int:
+    # only the complete ones among the first runs are aggregated, so this
+    # also works on the partial results of a running sweep
+    os.makedirs(f"{folder}/{CACHE}", exist_ok=True)
+    avgs: Avgs = dict()
+    for alg in ALGS:
+        avg = get_cached_avg(folder, alg, size, runs, keys[alg], force)
+        if avg.count == 0:
+            raise ValueError(
+                f"ERROR: '{get_filenames(folder, alg, size)[0]}' holds no complete runs."
+            )
+        if avg.count < runs:
+            print(f"Using {avg.count} of {runs} runs of '{alg}'.")
+        avgs[alg] = avg
+    return avgs
+
+
+def calc_convergence(avg: Aggregate) -> int:
     # TODO: better measure?
     for i, error in enumerate(avg.errors):
         if error <= 1:
@@ -116,23 +138,48 @@ def print_result(avgs: Avgs, runs: int) -> None:
     print(" | ".join([" " * n, "convergence", "best", "count", "q25", "q50", "q75"]))
     for alg, avg in avgs.items():
         converged_at = calc_convergence(avg)
-        best_steps: int = np.min(avg.tests)
-        best_count = len([x for x in avg.tests if x == best_steps]) / runs * 100
-        q25 = np.quantile(avg.tests, 0.25)
-        q50 = np.quantile(avg.tests, 0.5)
-        q75 = np.quantile(avg.tests, 0.75)
+        best_steps = avg.best
+        best_count = avg.test_counts[best_steps] / avg.count * 100
+        q25 = avg.quantile(0.25)
+        q50 = avg.quantile(0.5)
+        q75 = avg.quantile(0.75)
         print(
             f"{alg.rjust(n)} | {converged_at:11} | {best_steps:4} | {best_count:4.0f}% | {q25:3.0f} | {q50:3.0f} | {q75:3.0f}"
         )
 
 
-def plot_comparison1(avgs: Avgs, size: int) -> None:
+def plot_mean(
+    ax: plt.Axes,
+    avg: Aggregate,
+    metric: str,
+    color: str,
+    label: str | None = None,
+    bands: bool = False,
+) -> None:
+    # mean over the runs, optionally with a band of its 95% confidence interval
+    i = METRICS.index(metric)
+    mean = avg.mean[:, i]
+    ax.plot(mean, color=color, alpha=0.75, label=label)
+    if not bands:
+        return
+    confidence = avg.confidence()[:, i]
+    ax.fill_between(
+        np.arange(len(mean)),
+        mean - confidence,
+        mean + confidence,
+        color=color,
+        alpha=0.2,
+        linewidth=0,
+    )
+
+
+def plot_comparison1(avgs: Avgs, size: int, bands: bool = False) -> None:
     fig, axs = plt.subplots(ncols=3, figsize=(6.27, 1.425))
     for alg, avg in ((k, avgs[k]) for k in ["q", "bl", "crm"]):
         color, label = ALGS[alg]
-        axs[0].plot(avg.errors, color=color, alpha=0.75, label=label)
-        axs[1].plot(avg.rewards, color=color, alpha=0.75)
-        axs[2].plot(avg.steps, color=color, alpha=0.75)
+        plot_mean(axs[0], avg, "errors", color, label, bands)
+        plot_mean(axs[1], avg, "rewards", color, bands=bands)
+        plot_mean(axs[2], avg, "steps", color, bands=bands)
     axs[0].set_xlabel("Episode")
     axs[1].set_xlabel("Episode")
     axs[2].set_xlabel("Episode")
@@ -140,16 +187,16 @@ def plot_comparison1(avgs: Avgs, size: int) -> None:
     axs[1].set_title("Total reward")
     axs[2].set_title("Steps")
     axs[0].legend()
-    fig.savefig(f"paper/figures/cmp1_{size}x{size}.pdf", format="pdf")
+    fig.savefig(get_figure_filename("cmp1", size), format="pdf")
 
 
-def plot_comparison2(avgs: Avgs, size: int) -> None:
+def plot_comparison2(avgs: Avgs, size: int, bands: bool = False) -> None:
     fig, axs = plt.subplots(ncols=3, figsize=(6.27, 1.425))
     for alg, avg in ((k, avgs[k]) for k in ["bl2", "crm2"]):
         color, label = ALGS[alg]
-        axs[0].plot(avg.errors, color=color, alpha=0.75, label=label)
-        axs[1].plot(avg.rewards, color=color, alpha=0.75)
-        axs[2].plot(avg.steps, color=color, alpha=0.75)
+        plot_mean(axs[0], avg, "errors", color, label, bands)
+        plot_mean(axs[1], avg, "rewards", color, bands=bands)
+        plot_mean(axs[2], avg, "steps", color, bands=bands)
     axs[0].set_xlabel("Episode")
     axs[1].set_xlabel("Episode")
     axs[2].set_xlabel("Episode")
@@ -157,24 +204,25 @@ def plot_comparison2(avgs: Avgs, size: int) -> None:
     axs[1].set_title("Total reward")
     axs[2].set_title("Steps")
     axs[0].legend()
-    fig.savefig(f"paper/figures/cmp2_{size}x{size}.pdf", format="pdf")
+    fig.savefig(get_figure_filename("cmp2", size), format="pdf")
 
 
-def plot_comparison3(avgs: Avgs, size: int) -> None:
+def plot_comparison3(avgs: Avgs, size: int, bands: bool = False) -> None:
     fig, axs = plt.subplots(ncols=2, figsize=(4.2, 1.425))
     for alg, avg in avgs.items():
         color, label = ALGS[alg]
-        axs[0].plot(avg.errors, color=color, alpha=0.75, label=label)
-        axs[1].plot(avg.steps, color=color, alpha=0.75, label=label)
+        plot_mean(axs[0], avg, "errors", color, label, bands)
+        plot_mean(axs[1], avg, "steps", color, label, bands)
     axs[0].set_xlabel("Episode")
     axs[1].set_xlabel("Episode")
     axs[0].set_title("Total error")
     axs[1].set_title("Steps")
     axs[1].legend(loc="upper right", bbox_to_anchor=(2.1, 1), ncols=1)
-    fig.savefig(f"paper/figures/cmp3_{size}x{size}.pdf", format="pdf")
+    fig.savefig(get_figure_filename("cmp3", size), format="pdf")
 
 
-def plot_comparison4(avgs: Avgs, size: int) -> None:
+def plot_comparison4(avgs: Avgs, size: int, bands: bool = False) -> None:
+    # shows no means over episodes, so bands does not apply
     fig, ax = plt.subplots(figsize=(2.1, 1.425))
     data = [avg.tests for avg in avgs.values()]
     parts = ax.violinplot(
@@ -186,25 +234,115 @@ def plot_comparison4(avgs: Avgs, size: int) -> None:
     for pc, (color, _) in zip(parts["bodies"], ALGS.values()):
         pc.set_facecolor(color)
         pc.set_alpha(0.75)
-    ax.scatter(range(1, len(ALGS) + 1), np.mean(data, axis=1), color="k", marker="_")
+    means = [avg.test_mean for avg in avgs.values()]
+    ax.scatter(range(1, len(ALGS) + 1), means, color="k", marker="_")
     ax.set_xticks(
         range(1, len(ALGS) + 1),
         labels=[name for _, name in ALGS.values()],
         rotation="vertical",
     )
     ax.set_title("Testing steps distribution")
-    fig.savefig(f"paper/figures/cmp4_{size}x{size}.pdf", format="pdf")
+    fig.savefig(get_figure_filename("cmp4", size), format="pdf")
 
 
-def main() -> None:
-    runs, size, folder = get_args()
-    data = get_data(folder, runs, size)
-    avgs = get_avgs(data)
-    plot_comparison1(avgs, size)
-    plot_comparison2(avgs, size)
-    plot_comparison3(avgs, size)
-    plot_comparison4(avgs, size)
+# every figure with the algorithms it shows
+FIGURES: dict[str, tuple[Callable[[Avgs, int, bool], None], tuple[str, ...]]] = {
+    "cmp1": (plot_comparison1, ("q", "bl", "crm")),
+    "cmp2": (plot_comparison2, ("bl2", "crm2")),
+    "cmp3": (plot_comparison3, tuple(ALGS)),
+    "cmp4": (plot_comparison4, tuple(ALGS)),
+}
+
+
+def print_timings(folder: str, runs: int, size: int) -> None:
+    # mean time per training step in every phase over the timed runs
+    n = max(len(alg) for alg in ALGS)
+    lines: list[str] = []
+    for alg in ALGS:
+        if not os.path.exists(get_timings_filename(folder, alg, size)):
+            continue
+        timings = load_timings(folder, alg, size)[:runs]
+        timed = np.flatnonzero(~np.isnan(timings[:, 0, 0]))
+        if len(timed) == 0:
+            continue
+        seconds = timings[timed].sum(axis=(0, 1))
+        steps = load(folder, alg, size).runs[timed, :, 2].sum()
+        per_step = [f"{s / steps * 1e6:10.2f}" for s in seconds]
+        lines.append(
+            " | ".join([alg.rjust(n), *per_step, f"{steps / seconds.sum():7.0f}"])
+        )
+    if not lines:
+        return
+    print(f"Microseconds per training step of the timed runs among the first {runs}:")
+    print(" | ".join([" " * n, *(f"{p:>10}" for p in PHASES), "steps/s"]))
+    print("\n".join(lines))
+
+
+def get_figure_filename(name: str, size: int) -> str:
+    return f"paper/figures/{name}_{size}x{size}.pdf"
+
+
+def render(
+    avgs: Avgs,
+    size: int,
+    folder: str,
+    keys: dict[str, str],
+    force: bool = False,
+    bands: bool = False,
+) -> None:
+    # only figures whose algorithms changed since the last render are redrawn,
+    # each in its own process as usetex makes rendering slow
+    manifest_file = f"{folder}/{CACHE}/figures_{size}x{size}.json"
+    manifest: dict[str, str] = dict()
+    if os.path.exists(manifest_file):
+        with open(manifest_file, "r") as file:
+            manifest = json.load(file)
+
+    stale: dict[str, str] = dict()
+    for name, (_, algs) in FIGURES.items():
+        # figures with bands are keyed apart, without they keep their old keys
+        key = "".join(keys[alg] for alg in algs) + ("bands" if bands else "")
+        key = hashlib.sha256(key.encode()).hexdigest()
+        if (
+            force
+            or manifest.get(name) != key
+            or not os.path.exists(get_figure_filename(name, size))
+        ):
+            stale[name] = key
+    if not stale:
+        print("Figures are up to date.")
+        return
+
+    print(f"Rendering {', '.join(stale)}.")
+    with ProcessPoolExecutor(max_workers=len(stale)) as executor:
+        futures = {
+            name: executor.submit(
+                FIGURES[name][0],
+                {alg: avgs[alg] for alg in FIGURES[name][1]},
+                size,
+                bands,
+            )
+            for name in stale
+        }
+        for name, future in futures.items():
+            future.result()
+            manifest[name] = stale[name]
+            with open(manifest_file, "w") as file:
+                json.dump(manifest, file)
+
+
+def plot(
+    runs: int, size: int, folder: str, force: bool = False, bands: bool = False
+) -> None:
+    keys = {alg: fingerprint(folder, alg, size, runs) for alg in ALGS}
+    avgs = get_avgs(folder, runs, size, keys, force)
+    render(avgs, size, folder, keys, force, bands)
     print_result(avgs, runs)
+    print_timings(folder, runs, size)
+
+
+def main() -> None:
+    plot(*get_args())
 
 
 if __name__ == "__main__":
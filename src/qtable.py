@@ -0,0 +1,79 @@
+from dataclasses import dataclass, field
+
+import numpy as np
+from numpy.typing import DTypeLike, NDArray
+
+from utils import IntVec, Observation, RMState, State, Vec
+
+
+@dataclass
+class QTable:
+    # dense q-values of shape (observations, rm states, actions) where every
+    # observation is interned once by its raw bytes to a row index
+    n_actions: int
+    dtype: DTypeLike = np.float64
+    capacity: int = 1024
+    rng: np.random.Generator = field(default_factory=np.random.default_rng)
+    index: dict[bytes, int] = field(init=False)
+    values: NDArray[np.floating] = field(init=False)
+
+    def __post_init__(self) -> None:
+        self.index = dict()
+        self.values = self._init_values(self.capacity, 1)
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def _init_values(self, n_obs: int, n_rm_states: int) -> NDArray[np.floating]:
+        # unseen entries start uniformly random in [0, 1)
+        shape = (n_obs, n_rm_states, self.n_actions)
+        return self.rng.random(shape).astype(self.dtype, copy=False)
+
+    def _grow(self, n_obs: int, n_rm_states: int) -> None:
+        old_obs, old_rm_states, _ = self.values.shape
+        values = self._init_values(n_obs, n_rm_states)
+        values[:old_obs, :old_rm_states] = self.values
+        self.values = values
+
+    def intern(self, obs: Observation) -> int:
+        key = obs.tobytes()
+        i = self.index.get(key)
+        if i is None:
+            i = self.index[key] = len(self.index)
+            if i == self.values.shape[0]:
+                self._grow(2 * i, self.values.shape[1])
+        return i
+
+    def intern_all(self, obs: NDArray[np.uint8]) -> IntVec:
+        return np.array([self.intern(o) for o in obs], dtype=np.int64)
+
+    def reserve(self, u: RMState) -> None:
+        if u >= self.values.shape[1]:
+            self._grow(self.values.shape[0], u + 1)
+
+    def get(self, state: State) -> Vec:
+        obs, u = state
+        i = self.intern(obs)
+        self.reserve(u)
+        return self.values[i, u]
+
+    def save(self, filename: str) -> None:
+        n = len(self.index)
+        size = len(next(iter(self.index), b""))
+        observations = np.frombuffer(b"".join(self.index), dtype=np.uint8)
+        np.savez(
+            filename,
+            observations=observations.reshape(n, size),
+            values=self.values[:n],
+        )
+
+    @staticmethod
+    def load(filename: str) -> "QTable":
+        with np.load(filename) as data:
+            observations: NDArray[np.uint8] = data["observations"]
+            values: NDArray[np.floating] = data["values"]
+        table = QTable(values.shape[2], values.dtype, max(len(values), 1))
+        table.index = {obs.tobytes(): i for i, obs in enumerate(observations)}
+        table._grow(table.values.shape[0], values.shape[1])
+        table.values[: len(values)] = values
+        return table
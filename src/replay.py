@@ -0,0 +1,101 @@
+from dataclasses import dataclass, field
+
+import numpy as np
+from numpy.typing import NDArray
+
+from utils import Action, BoolVec, Experiences, IntVec, Reward, State, Vec
+
+
+@dataclass
+class ReplayBuffer:
+    # ring buffer of transitions stored as preallocated struct of arrays
+    capacity: int
+    obs_dim: int
+    rng: np.random.Generator = field(default_factory=np.random.default_rng)
+    obs: NDArray[np.uint8] = field(init=False)
+    u: IntVec = field(init=False)
+    actions: IntVec = field(init=False)
+    rewards: Vec = field(init=False)
+    next_obs: NDArray[np.uint8] = field(init=False)
+    next_u: IntVec = field(init=False)
+    terminals: BoolVec = field(init=False)
+    size: int = field(default=0, init=False)
+    pos: int = field(default=0, init=False)
+
+    def __post_init__(self) -> None:
+        assert self.capacity > 0, "Expected positive capacity."
+        self.obs = np.zeros((self.capacity, self.obs_dim), dtype=np.uint8)
+        self.u = np.zeros(self.capacity, dtype=np.int64)
+        self.actions = np.zeros(self.capacity, dtype=np.int64)
+        self.rewards = np.zeros(self.capacity)
+        self.next_obs = np.zeros((self.capacity, self.obs_dim), dtype=np.uint8)
+        self.next_u = np.zeros(self.capacity, dtype=np.int64)
+        self.terminals = np.zeros(self.capacity, dtype=np.bool_)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def add(
+        self,
+        state: State,
+        action: Action,
+        reward: Reward,
+        next_state: State,
+        terminal: bool,
+    ) -> int:
+        # returns the index the transition was written to
+        i = self.pos
+        self.obs[i], self.u[i] = state
+        self.actions[i] = action
+        self.rewards[i] = reward
+        self.next_obs[i], self.next_u[i] = next_state
+        self.terminals[i] = terminal
+        self.pos = (i + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+        return i
+
+    def add_many(
+        self,
+        obs: NDArray[np.uint8],
+        u: IntVec,
+        actions: IntVec,
+        rewards: Vec,
+        next_obs: NDArray[np.uint8],
+        next_u: IntVec,
+        terminals: BoolVec,
+    ) -> IntVec:
+        # returns the indices the transitions were written to, as if they were
+        # added one by one, so with more transitions than capacity only the
+        # last ones are kept and the indices of the others hold later ones
+        n = len(u)
+        indices = (self.pos + np.arange(n)) % self.capacity
+        keep = slice(max(n - self.capacity, 0), None)
+        written = indices[keep]
+        self.obs[written] = obs[keep]
+        self.u[written] = u[keep]
+        self.actions[written] = actions[keep]
+        self.rewards[written] = rewards[keep]
+        self.next_obs[written] = next_obs[keep]
+        self.next_u[written] = next_u[keep]
+        self.terminals[written] = terminals[keep]
+        self.pos = (self.pos + n) % self.capacity
+        self.size = min(self.size + n, self.capacity)
+        return indices
+
+    def add_batch(self, experiences: Experiences, actions: Action | IntVec) -> IntVec:
+        # adds the counterfactual transitions of one or a batch of envs,
+        # returns their indices in the order of experiences.u1.ravel()
+        s1, s2, u1, u2, rewards, terminals = experiences
+        shape = (*u1.shape, self.obs_dim)
+        return self.add_many(
+            np.broadcast_to(s1[..., None, :], shape).reshape(-1, self.obs_dim),
+            u1.reshape(-1),
+            np.broadcast_to(np.asarray(actions)[..., None], u1.shape).reshape(-1),
+            rewards.reshape(-1),
+            np.broadcast_to(s2[..., None, :], shape).reshape(-1, self.obs_dim),
+            u2.reshape(-1),
+            terminals.reshape(-1),
+        )
+
+    def sample(self, batch_size: int) -> IntVec:
+        return self.rng.integers(self.size, size=batch_size)
@@ -0,0 +1,221 @@
+import hashlib
+import os
+from dataclasses import dataclass, field
+from typing import NamedTuple
+
+import numpy as np
+from numpy.lib.format import open_memmap
+from numpy.typing import NDArray
+
+from timing import PHASES
+from utils import IntVec, Mat, Vec
+
+# metrics per episode in the last axis of the runs array
+METRICS: tuple[str, ...] = ("errors", "rewards", "steps")
+MISSING = -1
+
+
+class Run(NamedTuple):
+    errors: list[float]
+    rewards: list[float]
+    steps: list[int]
+    test_steps: int
+    timings: Mat | None = None  # seconds per episode and phase, see timing.py
+
+
+class Results(NamedTuple):
+    # runs of shape (runs, episodes, metrics) and the testing steps per run,
+    # which are MISSING until the run has been written completely
+    runs: NDArray[np.float64]
+    tests: IntVec
+
+
+def get_filenames(folder: str, alg: str, size: int) -> tuple[str, str]:
+    name = f"{folder}/{alg}_{size}x{size}"
+    return f"{name}.npy", f"{name}_tests.npy"
+
+
+def get_timings_filename(folder: str, alg: str, size: int) -> str:
+    return f"{folder}/{alg}_{size}x{size}_timings.npy"
+
+
+def load(folder: str, alg: str, size: int, writable: bool = False) -> Results:
+    runs_file, tests_file = get_filenames(folder, alg, size)
+    mode = "r+" if writable else "r"
+    return Results(
+        np.load(runs_file, mmap_mode=mode), np.load(tests_file, mmap_mode=mode)
+    )
+
+
+def load_timings(
+    folder: str, alg: str, size: int, writable: bool = False
+) -> NDArray[np.float64]:
+    # seconds of shape (runs, episodes, phases), NaN for runs without timings
+    return np.load(
+        get_timings_filename(folder, alg, size), mmap_mode="r+" if writable else "r"
+    )
+
+
+def reserve(
+    filename: str, runs: int, shape: tuple[int, ...], dtype: type, fill: float
+) -> None:
+    # creates the array of the given runs or grows it, keeping stored runs
+    old = None
+    if os.path.exists(filename):
+        old = np.load(filename, mmap_mode="r")
+        if old.shape[1:] != shape:
+            raise ValueError(
+                f"ERROR: '{filename}' holds runs of shape {old.shape[1:]}, not {shape}."
+            )
+        if len(old) >= runs:
+            return
+        old = np.array(old)
+
+    new = open_memmap(filename, mode="w+", dtype=dtype, shape=(runs, *shape))
+    new[:] = fill
+    if old is not None:
+        new[: len(old)] = old
+    new.flush()
+
+
+def create(
+    folder: str, alg: str, size: int, runs: int, episodes: int, timed: bool = False
+) -> None:
+    # makes room for at least the given number of runs, keeping stored ones
+    runs_file, tests_file = get_filenames(folder, alg, size)
+    reserve(runs_file, runs, (episodes, len(METRICS)), np.float64, np.nan)
+    reserve(tests_file, runs, (), np.int64, MISSING)
+    if timed:
+        timings_file = get_timings_filename(folder, alg, size)
+        reserve(timings_file, runs, (episodes, len(PHASES)), np.float64, np.nan)
+
+
+def save(folder: str, alg: str, size: int, run: int, data: Run) -> None:
+    # every run owns its row, so workers can write concurrently, the testing
+    # steps are written last to mark the run as complete
+    results = load(folder, alg, size, writable=True)
+    results.runs[run] = np.column_stack(data[:3])
+    results.runs.flush()
+    if data.timings is not None:
+        timings = load_timings(folder, alg, size, writable=True)
+        timings[run] = data.timings
+        timings.flush()
+    results.tests[run] = data.test_steps
+    results.tests.flush()
+
+
+def missing(folder: str, alg: str, size: int) -> IntVec:
+    return np.flatnonzero(load(folder, alg, size).tests == MISSING)
+
+
+def fingerprint(folder: str, alg: str, size: int, runs: int | None = None) -> str:
+    # changes whenever a run is written, without reading the runs themselves
+    runs_file, tests_file = get_filenames(folder, alg, size)
+    stat = os.stat(runs_file)
+    digest = hashlib.sha256(f"{runs}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    digest.update(np.load(tests_file, mmap_mode="r")[:runs].tobytes())
+    return digest.hexdigest()
+
+
+@dataclass
+class Aggregate:
+    # mean and variance per episode and metric over the runs added so far by
+    # Welford's algorithm, the testing steps are small non-negative integers
+    # and kept as an exact histogram for their quantiles
+    episodes: int
+    count: int = field(default=0, init=False)
+    mean: Mat = field(init=False)
+    m2: Mat = field(init=False)
+    test_counts: IntVec = field(init=False)
+
+    def __post_init__(self) -> None:
+        self.mean = np.zeros((self.episodes, len(METRICS)))
+        self.m2 = np.zeros_like(self.mean)
+        self.test_counts = np.zeros(0, dtype=np.int64)
+        self._delta: Mat = np.empty_like(self.mean)
+
+    def add(self, run: Mat, test_steps: int) -> None:
+        self.count += 1
+        delta = np.subtract(run, self.mean, out=self._delta)
+        self.mean += delta / self.count
+        delta *= run - self.mean
+        self.m2 += delta
+        if test_steps >= len(self.test_counts):
+            self.test_counts = np.pad(
+                self.test_counts, (0, test_steps + 1 - len(self.test_counts))
+            )
+        self.test_counts[test_steps] += 1
+
+    @property
+    def errors(self) -> Vec:
+        return self.mean[:, 0]
+
+    @property
+    def rewards(self) -> Vec:
+        return self.mean[:, 1]
+
+    @property
+    def steps(self) -> Vec:
+        return self.mean[:, 2]
+
+    @property
+    def variance(self) -> Mat:
+        return self.m2 / max(self.count - 1, 1)
+
+    def confidence(self, z: float = 1.96) -> Mat:
+        # half width of the normal confidence interval of the mean
+        return z * np.sqrt(self.variance / max(self.count, 1))
+
+    @property
+    def tests(self) -> IntVec:
+        return np.repeat(np.arange(len(self.test_counts)), self.test_counts)
+
+    @property
+    def test_mean(self) -> float:
+        return self.test_counts @ np.arange(len(self.test_counts)) / self.count
+
+    @property
+    def best(self) -> int:
+        return int(np.flatnonzero(self.test_counts)[0])
+
+    def save(self, filename: str, fingerprint: str = "") -> None:
+        np.savez(
+            filename,
+            count=self.count,
+            mean=self.mean,
+            m2=self.m2,
+            test_counts=self.test_counts,
+            fingerprint=fingerprint,
+        )
+
+    @staticmethod
+    def load(filename: str, fingerprint: str | None = None) -> "Aggregate | None":
+        # None if the aggregate was saved for other inputs
+        with np.load(filename) as data:
+            if fingerprint is not None and data["fingerprint"] != fingerprint:
+                return None
+            agg = Aggregate(len(data["mean"]))
+            agg.count = int(data["count"])
+            agg.mean[:] = data["mean"]
+            agg.m2[:] = data["m2"]
+            agg.test_counts = data["test_counts"]
+        return agg
+
+    def quantile(self, q: float) -> float:
+        # same as np.quantile of the testing steps, interpolating linearly
+        # between the closest ranks
+        pos = q * (self.count - 1)
+        lo, hi = np.searchsorted(
+            np.cumsum(self.test_counts), [np.floor(pos), np.ceil(pos)], side="right"
+        )
+        return lo + (hi - lo) * (pos - np.floor(pos))
+
+
+def aggregate(folder: str, alg: str, size: int, runs: int | None = None) -> Aggregate:
+    # streams the complete runs among the first ones from the memory map, so
+    # partial results of a running sweep can be aggregated as well
+    results = load(folder, alg, size)
+    agg = Aggregate(results.runs.shape[1])
+    for i in np.flatnonzero(results.tests[:runs] != MISSING):
+        agg.add(results.runs[i], int(results.tests[i]))
+    return agg
@@ -1,74 +1,423 @@
+import hashlib
+import json
+import os
 import re
+import shutil
+import tempfile
 from collections import defaultdict
+from collections.abc import Iterable, Mapping, Sequence
 from dataclasses import dataclass
+from operator import itemgetter
 
-from utils import Experiences, Observation, Props, Reward, RMState, State
+import numpy as np
+from numpy.typing import NDArray
+
+from utils import (
+    BoolVec,
+    Experiences,
+    Formula,
+    IntMat,
+    IntVec,
+    Label,
+    Mat,
+    Observation,
+    Props,
+    Reward,
+    RMState,
+    State,
+    Vec,
+)
+
+CONSTANTS = {"True": True, "False": False}
+TOKEN_PATTERN = re.compile(r"\s*(?:([a-zA-Z_]\w*)|(.))")
+# one transition per line, (u1, u2, "formula", reward) followed by an
+# optional comment
+NUMBER = r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?"
+LINE_PATTERN = re.compile(
+    rf"""\(\s*(\d+)\s*,\s*(\d+)\s*,\s*(?:"([^"]*)"|'([^']*)')\s*,\s*({NUMBER})\s*,?\s*\)"""
+)
+CACHE = "__rmcache__"
+CACHE_VERSION = 2
+TABLES = ("next_state_table", "reward_table", "terminal_table")
 
 
 def extract_variables(formula: str) -> set[str]:
-    return set(re.findall(r"\b[a-zA-Z_]\w*\b", formula))
+    return set(re.findall(r"\b[a-zA-Z_]\w*\b", formula)) - CONSTANTS.keys()
+
+
+def tokenize(formula: str) -> list[str]:
+    tokens: list[str] = []
+    for match in TOKEN_PATTERN.finditer(formula.rstrip()):
+        name, symbol = match.groups()
+        token = name or symbol
+        if token not in "!&|()" and name is None:
+            raise ValueError(f"Invalid formula: '{formula}'. Unexpected '{token}'.")
+        tokens.append(token)
+    return tokens
+
+
+def compile_formula(formula: str) -> Formula:
+    # recursive descent over the grammar
+    #   or  := and ("|" and)*
+    #   and := not ("&" not)*
+    #   not := "!" not | "(" or ")" | name
+    tokens = tokenize(formula)
+    pos = 0
+
+    def peek() -> str | None:
+        return tokens[pos] if pos < len(tokens) else None
+
+    def expect(token: str) -> None:
+        nonlocal pos
+        if peek() != token:
+            raise ValueError(f"Invalid formula: '{formula}'. Expected '{token}'.")
+        pos += 1
+
+    def parse_or() -> Formula:
+        nonlocal pos
+        left = parse_and()
+        while peek() == "|":
+            pos += 1
+            left = _or(left, parse_and())
+        return left
+
+    def parse_and() -> Formula:
+        nonlocal pos
+        left = parse_not()
+        while peek() == "&":
+            pos += 1
+            left = _and(left, parse_not())
+        return left
+
+    def parse_not() -> Formula:
+        nonlocal pos
+        token = peek()
+        if token == "!":
+            pos += 1
+            return _not(parse_not())
+        if token == "(":
+            pos += 1
+            inner = parse_or()
+            expect(")")
+            return inner
+        if token is None or token in "!&|()":
+            raise ValueError(f"Invalid formula: '{formula}'. Unexpected '{token}'.")
+        pos += 1
+        if token in CONSTANTS:
+            value = CONSTANTS[token]
+            return lambda _: value
+        return itemgetter(token)
 
+    compiled = parse_or()
+    if pos != len(tokens):
+        raise ValueError(f"Invalid formula: '{formula}'. Unexpected '{tokens[pos]}'.")
+    return compiled
 
-def parse_formula(formula: str) -> str:
-    formula = re.sub(r"(?<!\w)!(\w+)", r" not \1", formula)
-    formula = re.sub(r"&", " and ", formula)
-    formula = re.sub(r"\|", " or ", formula)
-    return formula
 
+def lazy_formula(formula: str) -> Formula:
+    # compiles the formula on its first evaluation, for loaded compiled RMs
+    # that step by their tables and only need the formulas to compile again
+    compiled: Formula | None = None
 
-def evaluate_formula(formula: str, props: Props) -> bool:
+    def evaluate(props: Props) -> bool:
+        nonlocal compiled
+        if compiled is None:
+            compiled = compile_formula(formula)
+        return compiled(props)
+
+    return evaluate
+
+
+def _not(f: Formula) -> Formula:
+    return lambda props: not f(props)
+
+
+def _and(f: Formula, g: Formula) -> Formula:
+    return lambda props: f(props) and g(props)
+
+
+def _or(f: Formula, g: Formula) -> Formula:
+    return lambda props: f(props) or g(props)
+
+
+def parse_line(
+    line: str, filename: str, lineno: int
+) -> tuple[tuple[RMState, RMState, str, Reward], Formula] | None:
+    # the transition on a line with its compiled formula, None for empty and
+    # comment lines
+    text = line.split("#", 1)[0].strip()
+    if not text:
+        return None
+    match = LINE_PATTERN.fullmatch(text)
+    if match is None:
+        raise ValueError(
+            f"{filename}:{lineno}: Invalid transition '{text}'. "
+            'Expected (u1, u2, "formula", reward).'
+        )
+    u1, u2, double, single, reward = match.groups()
+    formula = double if double is not None else single
     try:
-        # WARN: can execute arbitrary code
-        # TODO: make custom evaluator
-        return bool(eval(formula, {}, props))
-    except Exception as e:
-        raise ValueError(f"Invalid formula: '{formula}'. Error: {e}")
+        compiled = compile_formula(formula)
+    except ValueError as e:
+        raise ValueError(f"{filename}:{lineno}: {e}") from None
+    value = int(reward) if re.fullmatch(r"[-+]?\d+", reward) else float(reward)
+    return (int(u1), int(u2), formula, value), compiled
+
+
+def parse(
+    lines: Sequence[str], filename: str = "<string>"
+) -> tuple[list[tuple[RMState, RMState, str, Reward]], list[Formula]]:
+    # the transitions and their compiled formulas, which RM takes as they are
+    transitions: list[tuple[RMState, RMState, str, Reward]] = []
+    formulas: list[Formula] = []
+    edges: dict[tuple[RMState, RMState], int] = {}
+    for lineno, line in enumerate(lines, 1):
+        parsed = parse_line(line, filename, lineno)
+        if parsed is None:
+            continue
+        transition, formula = parsed
+        edge = transition[:2]
+        if edge in edges:
+            raise ValueError(
+                f"{filename}:{lineno}: Duplicate transition from {edge[0]} to "
+                f"{edge[1]}, first defined on line {edges[edge]}."
+            )
+        edges[edge] = lineno
+        transitions.append(transition)
+        formulas.append(formula)
+    if not transitions:
+        raise ValueError(f"{filename}: Expected at least one transition.")
+    return transitions, formulas
 
 
 @dataclass
 class RM:
     # https://github.com/RodrigoToroIcarte/reward_machines/blob/master/reward_machines/reward_machines/reward_machine.py
 
-    def __init__(self, transitions: list[tuple[RMState, RMState, str, Reward]]) -> None:
+    def __init__(
+        self,
+        transitions: list[tuple[RMState, RMState, str, Reward]],
+        formulas: Sequence[Formula] | None = None,
+        state_props: Mapping[RMState, Iterable[str]] | None = None,
+    ) -> None:
+        # formulas and state_props skip compiling the formulas and extracting
+        # their propositions if they are known already
         assert len(transitions) != 0, "Expected non-empty transition list."
+        if formulas is None:
+            formulas = [compile_formula(t[2]) for t in transitions]
+        assert len(formulas) == len(transitions), "Expected a formula per transition."
 
         states_set: set[RMState] = set()
         terminals_set: set[RMState] = set()
+        props_set: set[str] = set()
         self.delta_u: dict[RMState, dict[RMState, str]] = defaultdict(dict)
         self.delta_r: dict[RMState, dict[RMState, Reward]] = defaultdict(dict)
+        self.delta_f: dict[RMState, list[tuple[RMState, Formula]]] = defaultdict(list)
 
-        for u1, u2, formula, reward in transitions:
+        for (u1, u2, formula, reward), compiled in zip(transitions, formulas):
             states_set.add(u1)
             terminals_set.add(u2)
-            self.delta_u[u1][u2] = parse_formula(formula)
+            self.delta_u[u1][u2] = formula
             self.delta_r[u1][u2] = reward
+            self.delta_f[u1].append((u2, compiled))
 
         terminals_set.difference_update(states_set)
 
+        # propositions the outgoing edges of every state depend on, the label
+        # of a step only needs these for the current state
+        if state_props is None:
+            state_props = {
+                u: frozenset().union(*map(extract_variables, self.delta_u[u].values()))
+                for u in states_set | terminals_set
+            }
+        self.state_props: dict[RMState, frozenset[str]] = {
+            u: frozenset(state_props[u]) for u in sorted(states_set | terminals_set)
+        }
+        props_set.update(*self.state_props.values())
+
         self.states: list[RMState] = sorted(states_set)
         self.initial_state: RMState = self.states[0]
         self.terminal_states: list[RMState] = sorted(terminals_set)
+        self.state_array: IntVec = np.array(self.states, dtype=np.int64)
+
+        # compiled mode, see RM.compile
+        self.compiled: bool = False
+        self.propositions: list[str] = sorted(props_set)
+        self.prop_bits: dict[str, Label] = {}
+        self.state_bits: dict[RMState, list[tuple[str, Label]]] = {}
+        self.next_state_table: IntMat = np.empty((0, 0), dtype=np.int64)
+        self.reward_table: Mat = np.empty((0, 0))
+        self.terminal_table: BoolVec = np.empty(0, dtype=np.bool_)
 
     @staticmethod
     def from_file(filename: str) -> "RM":
         with open(filename, "r") as file:
             lines = file.readlines()
+        return RM(*parse(lines, filename))
 
-        # WARN: can execute arbitrary code
-        # TODO: create custom DSL and parser
-        transitions: list[tuple[RMState, RMState, str, Reward]] = [
-            eval(line) for line in lines
+    @staticmethod
+    def load(
+        filename: str,
+        propositions: Sequence[str] | None = None,
+        cache: str | None = None,
+    ) -> "RM":
+        # compiled RM of the file, the tables are cached on disk by the hash of
+        # the file and the proposition order and memory-mapped read-only, so
+        # the workers of a sweep share them instead of compiling again
+        with open(filename, "rb") as file:
+            digest = hashlib.sha256(file.read())
+        digest.update(json.dumps([CACHE_VERSION, propositions]).encode())
+        if cache is None:
+            cache = os.path.join(os.path.dirname(filename), CACHE)
+        name = os.path.splitext(os.path.basename(filename))[0]
+        folder = os.path.join(cache, f"{name}-{digest.hexdigest()[:16]}")
+        if not os.path.exists(folder):
+            RM.from_file(filename).compile(propositions).save(folder)
+        return RM.load_compiled(folder)
+
+    def save(self, folder: str) -> None:
+        # written to a temporary folder first and renamed, so concurrent
+        # writers never expose a partial cache and the first one wins
+        assert self.compiled, "Expected a compiled RM."
+        parent = os.path.dirname(folder) or "."
+        os.makedirs(parent, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=parent)
+        for table in TABLES:
+            np.save(os.path.join(tmp, f"{table}.npy"), getattr(self, table))
+        transitions = [
+            (u1, u2, formula, self.delta_r[u1][u2])
+            for u1, edges in self.delta_u.items()
+            for u2, formula in edges.items()
         ]
+        with open(os.path.join(tmp, "meta.json"), "w") as file:
+            json.dump(
+                {
+                    "version": CACHE_VERSION,
+                    "propositions": self.propositions,
+                    "transitions": transitions,
+                    "state_props": {
+                        u: sorted(props) for u, props in self.state_props.items()
+                    },
+                },
+                file,
+            )
+        try:
+            os.rename(tmp, folder)
+        except OSError:
+            shutil.rmtree(tmp)
+            if not os.path.exists(folder):
+                raise
+
+    @staticmethod
+    def load_compiled(folder: str) -> "RM":
+        with open(os.path.join(folder, "meta.json"), "r") as file:
+            meta = json.load(file)
+        if meta["version"] != CACHE_VERSION:
+            raise ValueError(f"ERROR: '{folder}' holds an RM of another version.")
+        # the rm steps by its tables, so its formulas are only compiled if
+        # it is compiled again
+        transitions = [tuple(transition) for transition in meta["transitions"]]
+        rm = RM(
+            transitions,
+            [lazy_formula(formula) for _, _, formula, _ in transitions],
+            {int(u): props for u, props in meta["state_props"].items()},
+        )
+        rm.propositions = meta["propositions"]
+        rm.index_propositions()
+        for table in TABLES:
+            setattr(
+                rm, table, np.load(os.path.join(folder, f"{table}.npy"), mmap_mode="r")
+            )
+        rm.compiled = True
+        return rm
+
+    def compile(self, propositions: Sequence[str] | None = None) -> "RM":
+        # tabulate delta_u and delta_r over all 2^|P| truth assignments, where
+        # proposition i of the given order is bit i of the label
+        if propositions is not None:
+            missing = set(self.propositions).difference(propositions)
+            assert not missing, f"Missing propositions {sorted(missing)} in order."
+            self.propositions = list(propositions)
+        self.index_propositions()
 
-        return RM(transitions)
+        n_states = max(self.states + self.terminal_states) + 1
+        n_labels = 1 << len(self.propositions)
+        self.next_state_table = np.full((n_states, n_labels), -1, dtype=np.int64)
+        self.reward_table = np.zeros((n_states, n_labels))
+        self.terminal_table = np.zeros(n_states, dtype=np.bool_)
+
+        # terminal states loop onto themselves without reward
+        self.next_state_table[self.terminal_states] = np.array(self.terminal_states)[
+            :, None
+        ]
+        self.terminal_table[self.terminal_states] = True
+
+        for label in range(n_labels):
+            props = self.get_props(label)
+            for u1 in self.states:
+                for u2, formula in self.delta_f[u1]:
+                    if formula(props):
+                        self.next_state_table[u1, label] = u2
+                        self.reward_table[u1, label] = self.delta_r[u1][u2]
+                        break
+
+        self.compiled = True
+        return self
+
+    def index_propositions(self) -> None:
+        self.prop_bits = {p: 1 << i for i, p in enumerate(self.propositions)}
+        self.state_bits = {
+            u: [(p, bit) for p, bit in self.prop_bits.items() if p in props]
+            for u, props in self.state_props.items()
+        }
+
+    def get_label(self, props: Props, u: RMState | None = None) -> Label:
+        # given a state, only the propositions it depends on are read and the
+        # other bits are left unset, which does not change its next state
+        label = 0
+        for p, bit in self.prop_bits.items() if u is None else self.state_bits[u]:
+            if props[p]:
+                label |= bit
+        return label
+
+    def get_labels(
+        self, props: Mapping[str, BoolVec], states: IntVec | None = None
+    ) -> IntVec:
+        # labels of a batch of envs given one array per proposition, given
+        # their states only the propositions these depend on are read
+        bits = self.prop_bits.items()
+        if states is None:
+            n_envs = len(next(iter(props.values())))
+        else:
+            n_envs = len(states)
+            needed = set().union(*(self.state_props[u] for u in set(states.tolist())))
+            bits = [(p, bit) for p, bit in bits if p in needed]
+        labels = np.zeros(n_envs, dtype=np.int64)
+        for p, bit in bits:
+            labels[props[p]] |= bit
+        return labels
+
+    def get_props(self, label: Label) -> Props:
+        return {p: bool(label >> i & 1) for i, p in enumerate(self.propositions)}
 
     def reset(self) -> RMState:
         return self.initial_state
 
-    def get_next_state(self, u1: RMState, props: Props) -> RMState:
-        for u2 in self.delta_u[u1]:
-            if evaluate_formula(self.delta_u[u1][u2], props):
-                return u2
+    def get_next_state(self, u1: RMState, props: Props | Label) -> RMState:
+        if self.compiled:
+            label = self.get_label(props, u1) if isinstance(props, Mapping) else props
+            u2 = int(self.next_state_table[u1, label])
+            if u2 < 0:
+                raise ValueError(
+                    f"No transition found for state {u1} and label {label:b}."
+                )
+            return u2
+        try:
+            for u2, formula in self.delta_f[u1]:
+                if formula(props):
+                    return u2
+        except KeyError as e:
+            raise ValueError(f"Unknown proposition {e} in transition from state {u1}.")
         raise ValueError(
             f"No transition found for state {u1} and propositions {props}."
         )
@@ -77,26 +426,72 @@ class RM:
         return self.delta_r[u1][u2]
 
     def get_experiences(
-        self, s1: Observation, s2: Observation, props: Props
+        self, s1: Observation, s2: Observation, props: Props | Label
     ) -> Experiences:
-        experiences: Experiences = []
-        for u1 in self.states:
-            u2 = self.get_next_state(u1, props)
-            r = self.get_reward(u1, u2)
-            terminal = u2 in self.terminal_states
-            experiences.append(((s1, u1), (s2, u2), r, terminal))
-        return experiences
+        u1 = self.state_array
+        if self.compiled:
+            label = self.get_label(props) if isinstance(props, Mapping) else props
+            u2 = self.next_state_table[u1, label]
+            if np.any(u2 < 0):
+                raise ValueError(f"No transition found for label {label:b}.")
+            rewards = self.reward_table[u1, label]
+            terminals = self.terminal_table[u2]
+        else:
+            next_states = [self.get_next_state(u, props) for u in self.states]
+            u2 = np.array(next_states, dtype=np.int64)
+            rewards = np.array(
+                [self.get_reward(u, v) for u, v in zip(self.states, next_states)]
+            )
+            terminals = np.isin(u2, self.terminal_states)
+        return Experiences(s1, s2, u1, u2, rewards, terminals)
 
     def step(
         self,
         state: State,
         obs: Observation,
-        props: Props,
-    ) -> tuple[State, Reward, bool, Experiences]:
+        props: Props | Label,
+        counterfactual: bool = False,
+    ) -> tuple[State, Reward, bool, Experiences | None]:
         s1, u1 = state
         assert u1 not in self.terminal_states, "Expected non-terminal state."
+        if self.compiled and isinstance(props, Mapping):
+            # counterfactual experiences need the label of every state
+            props = self.get_label(props, None if counterfactual else u1)
         u2 = self.get_next_state(u1, props)
         reward = self.get_reward(u1, u2)
         terminal = u2 in self.terminal_states
-        experiences = self.get_experiences(s1, obs, props)
+        experiences = None
+        if counterfactual:
+            experiences = self.get_experiences(s1, obs, props)
         return (obs, u2), reward, terminal, experiences
+
+    def step_batch(
+        self,
+        s1: NDArray[np.uint8],
+        u1: IntVec,
+        s2: NDArray[np.uint8],
+        labels: IntVec,
+        counterfactual: bool = False,
+    ) -> tuple[IntVec, Vec, BoolVec, Experiences | None]:
+        # step the rm states of a batch of envs, needs a compiled rm
+        assert self.compiled, "Expected compiled RM, call RM.compile."
+        u2 = self.next_state_table[u1, labels]
+        if np.any(u2 < 0):
+            raise ValueError("No transition found for some state and label.")
+        rewards = self.reward_table[u1, labels]
+        terminals = self.terminal_table[u2]
+        experiences = None
+        if counterfactual:
+            states = np.broadcast_to(self.state_array, (len(u1), len(self.states)))
+            next_states = self.next_state_table[states, labels[:, None]]
+            if np.any(next_states < 0):
+                raise ValueError("No transition found for some state and label.")
+            experiences = Experiences(
+                s1,
+                s2,
+                states,
+                next_states,
+                self.reward_table[states, labels[:, None]],
+                self.terminal_table[next_states],
+            )
+        return u2, rewards, terminals, experiences
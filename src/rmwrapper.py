@@ -1,88 +1,195 @@
+from collections.abc import Mapping
 from typing import Any, override
 
 import numpy as np
 from gymnasium import Wrapper, spaces
+from gymnasium.vector import AutoresetMode, VectorEnv, VectorWrapper
+from gymnasium.vector.utils import batch_space
 from numpy.typing import NDArray
 
-from env import RMEnv
 from rm import RM
+from utils import Action, BoolVec, IntVec, ObsBatch, Observation, Props, Reward, Vec
 
 
-class RMWrapper(Wrapper[Any, Any, Any, Any]):
+def get_observation_space(space: spaces.Space[Any], n_states: int) -> spaces.Box:
+    # the flat observation of the env followed by a one-hot of the rm state
+    assert isinstance(space, spaces.Box), "Expected a Box observation space."
+    high = max(float(space.high.max()), 1.0)
+    shape = (spaces.flatdim(space) + n_states,)
+    return spaces.Box(low=0, high=high, shape=shape, dtype=space.dtype)
+
+
+def merge_info(
+    info: dict[str, Any], reset_info: dict[str, Any], mask: BoolVec
+) -> dict[str, Any]:
+    # replaces the entries of the masked envs in the info of a vector env by
+    # those of their reset, keys are batched with a mask under "_" + key
+    info = dict(info)
+    for key, value in reset_info.items():
+        if key.startswith("_"):
+            continue
+        if key not in info:
+            info[key] = value
+            info[f"_{key}"] = reset_info[f"_{key}"]
+            continue
+        merged = np.array(info[key])
+        merged[mask] = np.asarray(value)[mask]
+        info[key] = merged
+        info[f"_{key}"] = np.asarray(info[f"_{key}"]) | mask
+    return info
+
+
+class RMWrapper(Wrapper[Observation, Action, Observation, Action]):
     # https://github.com/RodrigoToroIcarte/reward_machines/blob/master/reward_machines/reward_machines/rm_environment.py
+    # an env that returns its propositions as info, like envs.doorkey.DoorKey,
+    # rewarded by a compiled rm, the episode ends when either of them ends,
+    # an rm that ends on a truncated step is reported as truncated only
 
-    def __init__(self, env: RMEnv[Any, Any], reward_machines: list[RM]) -> None:
+    def __init__(
+        self,
+        env: Any,
+        rm: RM,
+        counterfactual: bool = False,
+    ) -> None:
         super().__init__(env)
-        self.rms: list[RM] = reward_machines
-        self.num_rm_states: int = sum([len(rm.get_states()) for rm in reward_machines])
-
-        self.observation_dict: spaces.Dict = spaces.Dict(
-            {
-                "features": env.observation_space,
-                "rm-state": spaces.Box(
-                    low=0, high=1, shape=(self.num_rm_states,), dtype=np.uint8
-                ),
-            }
-        )
-        flatdim = spaces.flatdim(self.observation_dict)
-        low: float = float(env.observation_space.low[0])
-        high: float = float(env.observation_space.high[0])
-        self.observation_space: spaces.Box = spaces.Box(
-            low=low, high=high, shape=(flatdim,), dtype=np.float32
+        assert rm.compiled, "Expected compiled RM, call RM.compile."
+        self.rm: RM = rm
+        self.counterfactual: bool = counterfactual
+        self.n_features: int = spaces.flatdim(env.observation_space)
+        self.observation_space = get_observation_space(
+            env.observation_space, len(rm.next_state_table)
         )
+        self.u: int = rm.initial_state
+        self.features: Observation = np.zeros(self.n_features, dtype=np.uint8)
 
-        self.rm_state_features: dict[tuple[int, int], NDArray[np.float32]] = {}
-        for rm_id, rm in enumerate(self.rms):
-            for u_id in rm.get_states():
-                u_features = np.zeros(self.num_rm_states, dtype=np.float32)
-                u_features[len(self.rm_state_features)] = 1
-                self.rm_state_features[(rm_id, u_id)] = u_features
-        self.rm_done_feat: NDArray[np.float32] = np.zeros(
-            self.num_rm_states, np.float32
-        )
+    def observe(self, obs: Observation) -> Observation:
+        rm_obs = np.zeros(self.observation_space.shape, self.observation_space.dtype)
+        rm_obs[: self.n_features] = obs.reshape(-1)
+        rm_obs[self.n_features + self.u] = 1
+        return rm_obs
 
-        self.current_rm_id: int = 1
-        self.current_rm: RM | None = None
+    @override
+    def reset(
+        self, *, seed: int | None = None, options: dict[str, Any] | None = None
+    ) -> tuple[Observation, Props]:
+        obs, props = self.env.reset(seed=seed, options=options)
+        self.u = self.rm.reset()
+        self.features = obs
+        return self.observe(obs), props
 
     @override
-    def reset(self, seed: int, options: int) -> tuple[int]:
-        self.obs = self.env.reset()
-        self.current_rm_id = (self.current_rm_id + 1) % len(self.rms)
-        self.current_rm = self.rms[self.current_rm_id]
-        self.current_u_id = self.current_rm.reset()
-
-        return self.get_observation(
-            self.obs, self.current_rm_id, self.current_u_id, False
+    def step(
+        self, action: Action
+    ) -> tuple[Observation, Reward, bool, bool, Mapping[str, Any]]:
+        obs, _, terminated, truncated, props = self.env.step(action)
+        (_, self.u), reward, terminal, experiences = self.rm.step(
+            (self.features, self.u), obs, props, self.counterfactual
         )
+        self.features = obs
+        # the propositions stay lazy unless the experiences read all of them
+        info: Mapping[str, Any] = props
+        if experiences is not None:
+            info = {**props, "experiences": experiences}
+        terminated = terminated or (terminal and not truncated)
+        return self.observe(obs), reward, terminated, truncated, info
+
 
-    def get_observation(self, next_obs, rm_id: int, u_id: int, done: bool) -> None:
-        rm_feat = self.rm_done_feat if done else self.rm_state_features[(rm_id, u_id)]
-        rm_obs = {"features": next_obs, "rm-state": rm_feat}
-        return spaces.flatten(self.observation_dict, rm_obs)
-
-    def step(self, action) -> None:
-        next_obs, original_reward, terminated, truncated, info = self.env.step(action)
-
-        # TODO: implement own Env type that has the method get_events and more restricted spaces
-        props = self.env.get_events()
-        # TODO: expect "terminated" and "truncated" to always be propositions? or just take them as parameters? probably the latter!
-        self.crm_params = (
-            self.obs,
-            action,
-            next_obs,
-            terminated,
-            truncated,
-            props,
-            info,
+class VecRMWrapper(VectorWrapper):
+    # RMWrapper for a gymnasium vector env of such envs, which stacks the
+    # propositions of the sub-envs into one array per proposition in info,
+    # the rm states are kept as an array and the one-hot is written into a
+    # preallocated observation that is overwritten by the next step like the
+    # observations of the vector env itself
+    #
+    # with next-step autoreset, the step after an env has ended only resets it
+    # and so does not step the rm, which restarts with zero reward, these envs
+    # are masked out of the counterfactual experiences by info["_experiences"]
+    # an rm that ends before its env ends the episode as well, so the env is
+    # reset by the wrapper on the next step like the vector env resets its own
+
+    def __init__(self, env: VectorEnv, rm: RM, counterfactual: bool = False) -> None:
+        super().__init__(env)
+        assert rm.compiled, "Expected compiled RM, call RM.compile."
+        mode = env.metadata.get("autoreset_mode", AutoresetMode.NEXT_STEP)
+        if mode not in (AutoresetMode.NEXT_STEP, AutoresetMode.DISABLED):
+            raise ValueError(f"ERROR: Unsupported autoreset mode {mode}.")
+        self.autoreset_mode: AutoresetMode = mode
+        self.rm: RM = rm
+        self.counterfactual: bool = counterfactual
+        self.n_features: int = spaces.flatdim(env.single_observation_space)
+        self.single_observation_space = get_observation_space(
+            env.single_observation_space, len(rm.next_state_table)
+        )
+        self.observation_space = batch_space(
+            self.single_observation_space, self.num_envs
         )
-        self.obs = next_obs
 
-        self.current_u_id, rm_reward, rm_done = self.current_rm.step(
-            self.current_u_id, props
+        self.states: IntVec = np.full(self.num_envs, rm.initial_state, dtype=np.int64)
+        self.features: ObsBatch = np.zeros(
+            (self.num_envs, self.n_features), dtype=self.single_observation_space.dtype
+        )
+        self.obs: NDArray[Any] = np.zeros(
+            (self.num_envs, *self.single_observation_space.shape),
+            dtype=self.single_observation_space.dtype,
         )
+        self.autoreset: BoolVec = np.zeros(self.num_envs, dtype=np.bool_)
+        # envs whose episode was ended by the rm only, which the vector env
+        # does not reset by itself
+        self.rm_ended: BoolVec = np.zeros(self.num_envs, dtype=np.bool_)
+        self._envs: IntVec = np.arange(self.num_envs)
 
-        done = rm_done or truncated or terminated
-        rm_obs = self.get_observation(
-            next_obs, self.current_rm_id, self.current_u_id, done
+    def observe(self, obs: NDArray[Any]) -> NDArray[Any]:
+        self.features = np.array(obs).reshape(self.num_envs, self.n_features)
+        self.obs[:, : self.n_features] = self.features
+        self.obs[:, self.n_features :] = 0
+        self.obs[self._envs, self.n_features + self.states] = 1
+        return self.obs
+
+    @override
+    def reset(
+        self,
+        *,
+        seed: int | list[int | None] | None = None,
+        options: dict[str, Any] | None = None,
+    ) -> tuple[NDArray[Any], dict[str, Any]]:
+        obs, info = self.env.reset(seed=seed, options=options)
+        # only the envs of a reset mask are reset, see VectorEnv.reset
+        mask = None if options is None else options.get("reset_mask")
+        envs = self._envs if mask is None else self._envs[mask]
+        self.states[envs] = self.rm.initial_state
+        self.autoreset[envs] = False
+        self.rm_ended[envs] = False
+        return self.observe(obs), info
+
+    @override
+    def step(
+        self, actions: NDArray[Any]
+    ) -> tuple[NDArray[Any], Vec, BoolVec, BoolVec, dict[str, Any]]:
+        obs, _, terminated, truncated, info = self.env.step(actions)
+        reset = self.autoreset
+        if self.autoreset_mode == AutoresetMode.NEXT_STEP and np.any(self.rm_ended):
+            # the step of these envs continued an ended episode, so it is
+            # replaced by a reset like the autoreset of the vector env
+            ended = self.rm_ended
+            obs, reset_info = self.env.reset(options={"reset_mask": ended.copy()})
+            info = merge_info(info, reset_info, ended)
+            terminated = terminated & ~ended
+            truncated = truncated & ~ended
+        self.states[reset] = self.rm.initial_state
+        s1 = self.features
+        s2 = np.array(obs).reshape(self.num_envs, self.n_features)
+        labels = self.rm.get_labels(info, None if self.counterfactual else self.states)
+        u2, rewards, terminals, experiences = self.rm.step_batch(
+            s1, self.states, s2, labels, self.counterfactual
         )
-        return rm_obs, rm_reward, done, info
+        u2[reset] = self.rm.initial_state
+        rewards[reset] = 0.0
+        terminals[reset] = False
+        self.states = u2
+        if experiences is not None:
+            info["experiences"] = experiences
+            info["_experiences"] = ~reset
+        self.rm_ended = terminals & ~(terminated | truncated)
+        terminated = terminated | (terminals & ~truncated)
+        self.autoreset = terminated | truncated
+        return self.observe(s2), rewards, terminated, truncated, info
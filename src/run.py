@@ -1,11 +1,16 @@
 import argparse
-import json
+from functools import cache
 from typing import NamedTuple
 
+import numpy as np
+
 from agent import Agent, CRMQAgent, QAgent
 from envs.doorkey import DoorKey
+from envs.vecdoorkey import VecDoorKey
+from results import Run, create, save
 from rm import RM
-from train import test, train
+from timing import Timings
+from train import test, train, train_vec
 
 VERBOSE = False
 MAX_STEPS = 250
@@ -13,21 +18,19 @@ ALPHA = 0.1
 GAMMA = 0.99
 EPSILON = 1.0
 MIN_EPSILON = 0.01
-
-
-class Run(NamedTuple):
-    errors: list[float]
-    rewards: list[float]
-    steps: list[int]
-    test_steps: int
+ALGORITHMS = ["q", "bl", "crm", "bl2", "crm2"]
 
 
 class Args(NamedTuple):
     alg: str
     size: int
     episodes: int
-    suffix: str
+    run: int
+    runs: int
     folder: str
+    envs: int
+    seed: int | None
+    timings: bool
 
 
 def get_args() -> Args:
@@ -36,7 +39,7 @@ def get_args() -> Args:
     )
     _ = parser.add_argument(
         "algorithm",
-        choices=["q", "bl", "crm", "bl2", "crm2"],
+        choices=ALGORITHMS,
         type=str,
         help="algorithm to use",
     )
@@ -55,19 +58,88 @@ def get_args() -> Args:
         help="number of episodes to run the algorithm",
     )
     _ = parser.add_argument(
-        "-x", "--suffix", type=str, default="", help="suffix for data filename"
+        "-x",
+        "--run",
+        type=int,
+        default=1,
+        help="index of the run in the data file, starting at 1 (default: 1)",
+    )
+    _ = parser.add_argument(
+        "-t",
+        "--runs",
+        type=int,
+        default=1,
+        help="number of runs the data file is created for if missing (default: 1)",
     )
     _ = parser.add_argument(
         "-f", "--folder", type=str, default="data", help="folder to store the data in"
     )
+    _ = parser.add_argument(
+        "-n",
+        "--envs",
+        type=int,
+        default=1,
+        help="number of environments to train on in parallel (default: 1)",
+    )
+    _ = parser.add_argument(
+        "-r", "--seed", type=int, default=None, help="seed for the run (default: none)"
+    )
+    _ = parser.add_argument(
+        "--timings",
+        action="store_true",
+        help="record the time spent in every phase of training",
+    )
     args = parser.parse_args()
     return Args(
         args.algorithm,
         args.size,
         args.episodes,
-        args.suffix,
+        args.run,
+        args.runs,
         args.folder,
+        args.envs,
+        args.seed,
+        args.timings,
+    )
+
+
+RM_FILES = {
+    "bl": "src/envs/doorkey.txt",
+    "crm": "src/envs/doorkey.txt",
+    "bl2": "src/envs/doorkey2.txt",
+    "crm2": "src/envs/doorkey2.txt",
+}
+
+
+@cache
+def load_rm(filename: str) -> RM:
+    # loaded once per process from the compiled cache, the RM keeps no
+    # per-episode state
+    return RM.load(filename, DoorKey.PROPOSITIONS)
+
+
+def make_agent(
+    alg: str, n_actions: int, episodes: int, rng: np.random.Generator
+) -> tuple[Agent, RM | None]:
+    decay: float = (MIN_EPSILON / EPSILON) ** (1 / episodes)
+    match alg:
+        case "q" | "bl" | "bl2":
+            agent_class = QAgent
+        case "crm" | "crm2":
+            agent_class = CRMQAgent
+        case _:
+            raise ValueError(f"ERROR: unknown algorithm '{alg}'.")
+    agent = agent_class(
+        n_actions=n_actions,
+        alpha=ALPHA,
+        gamma=GAMMA,
+        epsilon=EPSILON,
+        epsilon_decay=decay,
+        min_epsilon=MIN_EPSILON,
+        rng=rng,
     )
+    rm = load_rm(RM_FILES[alg]) if alg in RM_FILES else None
+    return agent, rm
 
 
 def run(
@@ -75,82 +147,50 @@ def run(
     env: DoorKey,
     rm: RM | None = None,
     episodes: int = 1,
+    n_envs: int = 1,
+    timed: bool = False,
 ) -> Run:
-    train_data = train(agent, env, rm, episodes, verbose=VERBOSE)
+    timings = Timings() if timed else None
+    if n_envs > 1:
+        vec_env = VecDoorKey(
+            n_envs, size=env.width, max_steps=env.max_steps, rng=env.np_random
+        )
+        train_data = train_vec(
+            agent, vec_env, rm, episodes, verbose=VERBOSE, timings=timings
+        )
+    else:
+        train_data = train(agent, env, rm, episodes, verbose=VERBOSE, timings=timings)
     test_data = test(agent, env, rm, verbose=VERBOSE)
-    return Run(*train_data, test_data)
-
-
-def save_data(data: Run, filename: str) -> None:
-    with open(filename, "w") as file:
-        json.dump(data, file)
+    if timings is None:
+        return Run(*train_data, test_data)
+    return Run(*train_data, test_data, timings.get_seconds())
+
+
+def run_algorithm(
+    alg: str,
+    size: int,
+    episodes: int,
+    n_envs: int = 1,
+    seed: int | np.random.SeedSequence | None = None,
+    timed: bool = False,
+) -> Run:
+    # agent and env draw from independent streams, so a run is reproducible
+    # from its seed regardless of which process it runs in
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    agent_seed, env_seed = seed.spawn(2)
+    env = DoorKey(size=size, max_steps=MAX_STEPS, rng=np.random.default_rng(env_seed))
+    agent, rm = make_agent(
+        alg, env.n_actions, episodes, np.random.default_rng(agent_seed)
+    )
+    return run(agent, env, rm, episodes, n_envs, timed)
 
 
 def main() -> None:
-    alg, size, episodes, suffix, folder = get_args()
-    decay: float = (MIN_EPSILON / EPSILON) ** (1 / episodes)
-
-    env = DoorKey(size=size, max_steps=MAX_STEPS)
-
-    match alg:
-        case "q":
-            agent = QAgent(
-                n_actions=env.n_actions,
-                alpha=ALPHA,
-                gamma=GAMMA,
-                epsilon=EPSILON,
-                epsilon_decay=decay,
-                min_epsilon=MIN_EPSILON,
-            )
-            data = run(agent, env, episodes=episodes)
-        case "bl":
-            rm = RM.from_file("src/envs/doorkey.txt")
-            agent = QAgent(
-                n_actions=env.n_actions,
-                alpha=ALPHA,
-                gamma=GAMMA,
-                epsilon=EPSILON,
-                epsilon_decay=decay,
-                min_epsilon=MIN_EPSILON,
-            )
-            data = run(agent, env, rm, episodes)
-        case "crm":
-            rm = RM.from_file("src/envs/doorkey.txt")
-            agent = CRMQAgent(
-                n_actions=env.n_actions,
-                alpha=ALPHA,
-                gamma=GAMMA,
-                epsilon=EPSILON,
-                epsilon_decay=decay,
-                min_epsilon=MIN_EPSILON,
-            )
-            data = run(agent, env, rm, episodes)
-        case "bl2":
-            rm = RM.from_file("src/envs/doorkey2.txt")
-            agent = QAgent(
-                n_actions=env.n_actions,
-                alpha=ALPHA,
-                gamma=GAMMA,
-                epsilon=EPSILON,
-                epsilon_decay=decay,
-                min_epsilon=MIN_EPSILON,
-            )
-            data = run(agent, env, rm, episodes)
-        case "crm2":
-            rm = RM.from_file("src/envs/doorkey2.txt")
-            agent = CRMQAgent(
-                n_actions=env.n_actions,
-                alpha=ALPHA,
-                gamma=GAMMA,
-                epsilon=EPSILON,
-                epsilon_decay=decay,
-                min_epsilon=MIN_EPSILON,
-            )
-            data = run(agent, env, rm, episodes)
-        case _:
-            raise ValueError(f"ERROR: unknown algorithm '{alg}'.")
-
-    save_data(data, f"{folder}/{alg}_{size}x{size}_{suffix}.json")
+    alg, size, episodes, run_index, runs, folder, n_envs, seed, timed = get_args()
+    create(folder, alg, size, max(run_index, runs), episodes, timed)
+    data = run_algorithm(alg, size, episodes, n_envs, seed, timed)
+    save(folder, alg, size, run_index - 1, data)
 
 
 if __name__ == "__main__":
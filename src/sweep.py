@@ -0,0 +1,180 @@
+import argparse
+import os
+import sys
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import NamedTuple
+
+import numpy as np
+
+import results
+from run import ALGORITHMS, run_algorithm
+
+
+class Task(NamedTuple):
+    alg: str
+    run: int  # row in the results of alg
+    size: int
+    episodes: int
+    folder: str
+    seed: np.random.SeedSequence
+    timed: bool
+
+
+class Args(NamedTuple):
+    size: int
+    episodes: int
+    runs: int
+    folder: str
+    workers: int
+    seed: int
+    algorithms: list[str]
+    timings: bool
+
+
+def get_args() -> Args:
+    parser = argparse.ArgumentParser(
+        description="Run every algorithm for a number of runs and plot the results."
+    )
+    _ = parser.add_argument(
+        "-s",
+        "--size",
+        type=int,
+        default=5,
+        help="size of the doorkey environment (default: 5x5)",
+    )
+    _ = parser.add_argument(
+        "-e",
+        "--episodes",
+        type=int,
+        default=1000,
+        help="number of episodes to run the algorithms",
+    )
+    _ = parser.add_argument(
+        "-n", "--runs", type=int, default=100, help="number of runs to perform"
+    )
+    _ = parser.add_argument(
+        "-f", "--folder", type=str, default="data", help="folder to store the data in"
+    )
+    _ = parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=max(1, round((os.cpu_count() or 1) * 3 / 4)),
+        help="number of worker processes (default: 3/4 of the cpus)",
+    )
+    _ = parser.add_argument(
+        "-r",
+        "--seed",
+        type=int,
+        default=0,
+        help="base seed that the seeds of the runs are spawned from (default: 0)",
+    )
+    _ = parser.add_argument(
+        "-a",
+        "--algorithms",
+        nargs="+",
+        choices=ALGORITHMS,
+        default=ALGORITHMS,
+        help="algorithms to run (default: all)",
+    )
+    _ = parser.add_argument(
+        "--timings",
+        action="store_true",
+        help="record the time spent in every phase of training",
+    )
+    args = parser.parse_args()
+    return Args(
+        args.size,
+        args.episodes,
+        args.runs,
+        args.folder,
+        args.workers,
+        args.seed,
+        args.algorithms,
+        args.timings,
+    )
+
+
+def get_tasks(args: Args) -> list[Task]:
+    # run i of every algorithm gets the i-th child of the base seed, so skipping
+    # runs already written by an earlier sweep does not change the others
+    seeds = np.random.SeedSequence(args.seed).spawn(args.runs)
+    missing = {
+        alg: set(results.missing(args.folder, alg, args.size).tolist())
+        for alg in args.algorithms
+    }
+    return [
+        Task(alg, i, args.size, args.episodes, args.folder, seeds[i], args.timings)
+        for i in range(args.runs)
+        for alg in args.algorithms
+        if i in missing[alg]
+    ]
+
+
+def run_task(task: Task) -> None:
+    data = run_algorithm(
+        task.alg, task.size, task.episodes, seed=task.seed, timed=task.timed
+    )
+    results.save(task.folder, task.alg, task.size, task.run, data)
+
+
+def report(done: int, total: int, size: int, episodes: int) -> None:
+    print(
+        f"\rRunning algorithms on {size}x{size} for {episodes} episodes: "
+        f"{done}/{total} ({done / total:.0%})",
+        end="",
+        flush=True,
+    )
+
+
+def main() -> None:
+    args = get_args()
+    os.makedirs(args.folder, exist_ok=True)
+    for alg in args.algorithms:
+        results.create(
+            args.folder, alg, args.size, args.runs, args.episodes, args.timings
+        )
+    tasks = get_tasks(args)
+    skipped = args.runs * len(args.algorithms) - len(tasks)
+    if skipped:
+        print(f"Skipping {skipped} runs that are already stored in '{args.folder}'.")
+
+    if tasks:
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            futures = {executor.submit(run_task, task): task for task in tasks}
+            for done, future in enumerate(as_completed(futures), 1):
+                error = future.exception()
+                if error is not None:
+                    # the traceback of the worker is chained as the cause
+                    task = futures[future]
+                    executor.shutdown(cancel_futures=True)
+                    print(
+                        f"\nERROR: run {task.run + 1} of '{task.alg}' failed in {task}:",
+                        file=sys.stderr,
+                    )
+                    traceback.print_exception(error)
+                    sys.exit(1)
+                report(done, len(tasks), args.size, args.episodes)
+        print()
+
+    # plotting needs matplotlib, so only the main process imports it
+    from plot import ALGS, plot
+
+    missing = [
+        alg
+        for alg in ALGS
+        if not os.path.exists(results.get_filenames(args.folder, alg, args.size)[0])
+    ]
+    if missing:
+        print(
+            f"Finished running algorithms. Not plotting as '{args.folder}' holds "
+            f"no results of {', '.join(missing)}."
+        )
+        return
+    print("Finished running algorithms. Generating plots.")
+    plot(args.runs, args.size, args.folder)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,27 @@
+from collections.abc import Sequence
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from utils import Mat
+
+# phases of a training step in the order they run
+PHASES: tuple[str, ...] = ("get_action", "env_step", "rm_step", "update")
+
+
+@dataclass
+class Timings:
+    # cumulative wall time in seconds per phase of every episode, for a batch
+    # of envs the time of a batched call is split evenly among the envs, every
+    # phase runs once per step so the calls and steps per second follow from
+    # the episode lengths stored with the run, see plot.print_timings
+    seconds: list[list[float]] = field(default_factory=list)
+
+    def __len__(self) -> int:
+        return len(self.seconds)
+
+    def add(self, seconds: Sequence[float]) -> None:
+        self.seconds.append(list(seconds))
+
+    def get_seconds(self) -> Mat:
+        return np.array(self.seconds).reshape(-1, len(PHASES))
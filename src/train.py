@@ -1,7 +1,13 @@
+from time import perf_counter
+
+import numpy as np
+
 from agent import Agent
 from env import Env
 from envs.doorkey import DoorKey
+from envs.vecdoorkey import VecDoorKey
 from rm import RM
+from timing import PHASES, Timings
 
 IDX_TO_ACTION = {
     0: "left",
@@ -21,10 +27,13 @@ def train(
     episodes: int = 1,
     report_each: int = 1,
     verbose: bool = True,
+    timings: Timings | None = None,
 ) -> tuple[list[float], list[float], list[int]]:
+    # the phases of every step are timed into timings if given
     errors: list[float] = []
     rewards: list[float] = []
     steps: list[int] = []
+    timed = timings is not None
 
     for episode in range(1, episodes + 1):
         obs, _ = env.reset()
@@ -35,22 +44,37 @@ def train(
         total_reward = 0
         total_error = 0
         length = 0
+        seconds = [0.0] * len(PHASES)
 
         terminal = False
         while not terminal:
+            if timed:
+                t0 = perf_counter()
             action = agent.get_action(state, explore=True)
 
+            if timed:
+                t1 = perf_counter()
             next_obs, reward, terminated, truncated, props = env.step(action)
             next_state = (next_obs, 0)
             terminal = terminated or truncated
-            experiences = []
+            experiences = None
+            if timed:
+                t2 = perf_counter()
             if rm is not None:
                 next_state, reward, terminal, experiences = rm.step(
-                    state, next_obs, props
+                    state, next_obs, props, agent.counterfactual
                 )
+            if timed:
+                t3 = perf_counter()
             error = agent.update(
                 state, action, reward, next_state, terminal, experiences
             )
+            if timed:
+                t4 = perf_counter()
+                seconds[0] += t1 - t0
+                seconds[1] += t2 - t1
+                seconds[2] += t3 - t2
+                seconds[3] += t4 - t3
             state = next_state
 
             total_error += abs(error)
@@ -60,14 +84,11 @@ def train(
         errors.append(total_error)
         rewards.append(total_reward)
         steps.append(length)
+        if timed:
+            timings.add(seconds)
 
         if verbose and episode % report_each == 0:
-            err = sum(errors[episode - report_each : episode]) / report_each
-            rew = sum(rewards[episode - report_each : episode]) / report_each
-            stp = sum(steps[episode - report_each : episode]) / report_each
-            print(
-                f"episode {episode:4}: error={err:6.2f}, reward={rew:4.1f}, steps={stp:3.0f}, epsilon={agent.epsilon:.3f}"
-            )
+            report(errors, rewards, steps, report_each, agent.epsilon)
 
         agent.decay_epsilon()
 
@@ -75,6 +96,105 @@ def train(
     return errors, rewards, steps
 
 
+def train_vec(
+    agent: Agent,
+    env: VecDoorKey,
+    rm: RM | None = None,
+    episodes: int = 1,
+    report_each: int = 1,
+    verbose: bool = True,
+    timings: Timings | None = None,
+) -> tuple[list[float], list[float], list[int]]:
+    # like train but steps all envs of the batch at once, finished episodes are
+    # recorded in the order they end and their envs are reset automatically
+    assert rm is None or rm.compiled, "Expected compiled RM, call RM.compile."
+    errors: list[float] = []
+    rewards: list[float] = []
+    steps: list[int] = []
+    timed = timings is not None
+
+    obs, _ = env.reset()
+    initial_state = 0 if rm is None else rm.reset()
+    u = np.full(env.n_envs, initial_state)
+    total_reward = np.zeros(env.n_envs)
+    total_error = np.zeros(env.n_envs)
+    length = np.zeros(env.n_envs, dtype=np.int64)
+    seconds = np.zeros((env.n_envs, len(PHASES)))
+
+    while len(steps) < episodes:
+        if timed:
+            t0 = perf_counter()
+        actions = agent.get_actions(obs, u, explore=True)
+
+        if timed:
+            t1 = perf_counter()
+        next_obs, reward, terminated, truncated, props = env.step(actions)
+        next_u = u
+        terminal = terminated | truncated
+        experiences = None
+        if timed:
+            t2 = perf_counter()
+        if rm is not None:
+            next_u, reward, terminal, experiences = rm.step_batch(
+                obs,
+                u,
+                next_obs,
+                rm.get_labels(props, None if agent.counterfactual else u),
+                agent.counterfactual,
+            )
+        if timed:
+            t3 = perf_counter()
+        error = agent.update_batch(
+            obs, u, actions, reward, next_obs, next_u, terminal, experiences
+        )
+        if timed:
+            t4 = perf_counter()
+            seconds += np.array([t1 - t0, t2 - t1, t3 - t2, t4 - t3]) / env.n_envs
+        obs, u = next_obs, next_u
+
+        total_error += np.abs(error)
+        total_reward += reward
+        length += 1
+
+        done = np.flatnonzero(terminal | truncated)
+        for i in done.tolist():
+            errors.append(float(total_error[i]))
+            rewards.append(float(total_reward[i]))
+            steps.append(int(length[i]))
+            if timed and len(steps) <= episodes:
+                timings.add(seconds[i].tolist())
+            if verbose and len(steps) % report_each == 0:
+                report(errors, rewards, steps, report_each, agent.epsilon)
+            agent.decay_epsilon()
+
+        if len(done) > 0:
+            env.reset_envs(done)
+            obs[done] = env.get_obs()[done]
+            u[done] = initial_state
+            total_error[done] = 0
+            total_reward[done] = 0
+            length[done] = 0
+            seconds[done] = 0
+
+    env.close()
+    return errors[:episodes], rewards[:episodes], steps[:episodes]
+
+
+def report(
+    errors: list[float],
+    rewards: list[float],
+    steps: list[int],
+    report_each: int,
+    epsilon: float,
+) -> None:
+    err = sum(errors[-report_each:]) / report_each
+    rew = sum(rewards[-report_each:]) / report_each
+    stp = sum(steps[-report_each:]) / report_each
+    print(
+        f"episode {len(steps):4}: error={err:6.2f}, reward={rew:4.1f}, steps={stp:3.0f}, epsilon={epsilon:.3f}"
+    )
+
+
 def test(
     agent: Agent,
     env: Env,
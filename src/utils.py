@@ -1,17 +1,30 @@
+from collections.abc import Callable, Mapping
+from typing import NamedTuple
+
 import numpy as np
 
 type Vec = np.ndarray[tuple[int], np.dtype[np.float64]]
 type Mat = np.ndarray[tuple[int, int], np.dtype[np.float64]]
+type IntMat = np.ndarray[tuple[int, int], np.dtype[np.int64]]
+type IntVec = np.ndarray[tuple[int], np.dtype[np.int64]]
+type BoolVec = np.ndarray[tuple[int], np.dtype[np.bool_]]
 type Observation = np.ndarray[tuple[int], np.dtype[np.uint8]]
+type ObsBatch = np.ndarray[tuple[int, int], np.dtype[np.uint8]]
 type RMState = int
 type State = tuple[Observation, RMState]
 type Action = int
 type Reward = float
-type Experience = tuple[State, State, float, bool]
-type Experiences = list[Experience]
-type Props = dict[str, bool]
+type Props = Mapping[str, bool]
+type Label = int  # bitmask of true propositions, see RM.compile
+type Formula = Callable[[Props], bool]
 
 
-def hash_state(state: State) -> tuple[int, ...]:
-    obs, u = state
-    return (u, *tuple(obs.astype(int).tolist()))
+class Experiences(NamedTuple):
+    # counterfactual experiences for every rm state u1 that share observations,
+    # for a batch of envs every field has an additional leading env axis
+    s1: Observation
+    s2: Observation
+    u1: IntVec
+    u2: IntVec
+    rewards: Vec
+    terminals: BoolVec